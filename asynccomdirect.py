@@ -0,0 +1,295 @@
+from comdirect import Comdirect
+from comdirect import ComdirectRequest
+from comdirect import Request_2_1
+from comdirect import Request_2_2
+from comdirect import Request_2_3
+from comdirect import Request_2_4
+from comdirect import Request_2_5
+from comdirect import Request_3_1_1
+from comdirect import Request_4_1_1
+from comdirect import Request_4_1_3
+from comdirect import Request_9_1_1
+from comdirect import Request_9_1_2
+from comdirect import Request_Challenge_Status
+from comdirect import filter_account_page
+from comdirect import merge_accounts
+from comdirect import passed_window
+from datetime import datetime
+from typing import Type
+import asyncio
+import httpx
+import logging
+import math
+import metrics
+import secrets
+import time
+
+_logger = logging.getLogger(__name__)
+
+
+class AsyncComdirect(Comdirect):
+    """Variant of Comdirect that performs its requests with asyncio.
+
+    It shares the Request_* definitions and the session state handling with
+    Comdirect but sends independent requests (transaction pages, balances,
+    postbox downloads) concurrently as far as the rate limit allows.
+    Use it as async context manager:
+
+        async with AsyncComdirect(...) as c:
+            transactions = await c.get_transactions(earliest, False)
+    """
+
+    def __init__(self, client_id, client_secret, zugangsnummer, pin, concurrency=10) -> None:
+        super().__init__(client_id, client_secret, zugangsnummer, pin)
+        self.concurrency = concurrency
+        self.client = None
+
+    async def __aenter__(self):
+        self.client = httpx.AsyncClient(timeout=60)
+        # API terms of use allow a maxmimum of 10 requests per second. This
+        # limits this client only if no shared rate limiter is configured.
+        self.local_limit = asyncio.Semaphore(10)
+        return self
+
+    async def __aexit__(self, *args):
+        await self.client.aclose()
+        self.client = None
+
+    async def login(self, interactive) -> bool:
+        if self.is_logged_in(self.TOKEN_MIN_VALIDITY):
+            _logger.debug("Access token is still valid")
+            return True
+
+        if self.state_store is None:
+            return await self.__login(interactive)
+
+        lock = self.state_store.lock()
+        start = time.perf_counter()
+        await asyncio.to_thread(lock.acquire)
+        metrics.observe('comdirect_api_lock_wait_seconds', time.perf_counter() - start)
+        try:
+            # Another process may have refreshed the tokens in the meantime
+            self.state_store.load(self)
+            if self.is_logged_in(self.TOKEN_MIN_VALIDITY):
+                _logger.debug("Access token was refreshed by another process")
+                return True
+            # See Comdirect.login() why a failed login is not saved
+            logged_in = await self.__login(interactive)
+            self.state_store.save(self)
+            return logged_in
+        finally:
+            lock.release()
+
+    async def __login(self, interactive) -> bool:
+        try:
+            if self.refresh_token_expiry > datetime.now():
+                _logger.debug(
+                    "Refresh token is still valid. Performing access token refresh")
+                await self.__perform_request(Request_3_1_1(
+                    self.client_id, self.client_secret, self.refresh_token))
+                return True
+
+            if self.is_logged_in():
+                _logger.debug(
+                    "Access token is about to expire but can't be refreshed")
+                return True
+
+            if not interactive:
+                _logger.info(
+                    "Tokens are no longer valid. Login with TAN not performed in non-interactive mode")
+                return False
+
+            _logger.debug("Tokens are no longer valid. Starting login flow")
+            await self.__perform_login_flow()
+            return True
+        except:
+            _logger.error("Login failed. Invalidating tokens.")
+            self.access_token_expiry = datetime.now()
+            self.refresh_token_expiry = datetime.now()
+            raise
+
+    async def get_balances(self, interactive):
+        if not await self.login(interactive):
+            _logger.info('Not logged in. Stopping get_balances.')
+            return []
+        response = await self.__perform_request(Request_4_1_1(
+            self.access_token, self.session_id, self.request_id))
+        return response.json()['values']
+
+    async def get_transactions(self, earliest, interactive, newer_than=None, latest=None):
+        # Same result as Comdirect.get_transactions(). After the first page
+        # pages are requested in batches of concurrency pages, so at most
+        # concurrency - 1 pages beyond the last required one are retrieved.
+        if not await self.login(interactive):
+            _logger.info('Not logged in. Stopping get_transactions.')
+            return []
+
+        try:
+            await self.__perform_request(Request_4_1_1(
+                self.access_token, self.session_id, self.request_id))
+
+            stop = newer_than if newer_than else earliest
+            # Accounts are paged concurrently, the rate limit
+            # applies to all their requests together
+            results = await asyncio.gather(*[
+                self.__get_account_transactions(account_UUID, earliest, stop, latest)
+                for account_UUID in self.account_UUIDs])
+            return merge_accounts(results)
+
+        except:
+            _logger.error(
+                "Failed to retrieve account transactions. Invalidating tokens.")
+            self.access_token_expiry = datetime.now()
+            self.refresh_token_expiry = datetime.now()
+            raise
+
+    async def __get_account_transactions(self, account_UUID, earliest, stop, latest):
+        transactions = []
+        paging_first = 0
+        page_size = 0
+        matches = 1
+
+        while paging_first < matches:
+            # The first page tells the page size and how many transactions
+            # there are at all, the following pages are requested in batches
+            count = 1 if paging_first == 0 else min(
+                self.concurrency, math.ceil((matches - paging_first) / page_size))
+            pages = await asyncio.gather(*[
+                self.__perform_request(Request_4_1_3(
+                    self.access_token, self.session_id, self.request_id, account_UUID,
+                    paging_first + i * page_size, stop, latest))
+                for i in range(count)])
+
+            for response in pages:
+                json = response.json()
+                txs = json['values']
+                matches = json['paging']['matches']
+                if not txs:
+                    return transactions
+
+                transactions += filter_account_page(account_UUID, txs, earliest, latest)
+                page_size = max(page_size, len(txs))
+                paging_first += len(txs)
+
+                if passed_window(txs, stop):
+                    return transactions
+
+        return transactions
+
+    async def get_postbox_documents(self, interactive, get_ads=False, get_archived=False, get_read=False, skip=None):
+        return [document async for document in self.iter_postbox_documents(
+            interactive, get_ads, get_archived, get_read, skip)]
+
+    async def iter_postbox_documents(self, interactive, get_ads=False, get_archived=False, get_read=False, skip=None):
+        # The documents of each listing page are downloaded concurrently
+        # and yielded in the order of the listing
+        if not await self.login(interactive):
+            _logger.info('Not logged in. Stopping get_postbox_documents.')
+            return
+
+        try:
+            paging_first = 0
+            matches = 1
+
+            while paging_first < matches:
+                documentsResponse = await self.__perform_request(Request_9_1_1(
+                    self.access_token, self.session_id, self.request_id, paging_first))
+
+                responseJson = documentsResponse.json()
+                documentsJson = responseJson['values']
+                paging_first += len(documentsJson)
+                matches = responseJson['paging']['matches']
+                if len(documentsJson) == 0:
+                    break
+
+                selected = []
+                for document in documentsJson:
+                    filtered = document['advertisement'] and not get_ads
+                    filtered = filtered or (
+                        document['documentMetaData']['archived'] and not get_archived
+                    )
+                    filtered = filtered or (
+                        document['documentMetaData']['alreadyRead'] and not get_read
+                    )
+                    filtered = filtered or (skip is not None and skip(document))
+                    if not (filtered):
+                        selected.append(document)
+
+                responses = await asyncio.gather(*[
+                    self.__perform_request(Request_9_1_2(
+                        self.access_token, self.session_id, self.request_id,
+                        document['documentId'], document['mimeType']))
+                    for document in selected])
+
+                for document, response in zip(selected, responses):
+                    if document['mimeType'] == 'text/html':
+                        document['content'] = response.text
+                    if document['mimeType'] == 'application/pdf':
+                        document['content'] = response.content
+                    yield document
+
+        except:
+            _logger.error(
+                "Failed to retrieve documents. Invalidating tokens.")
+            self.access_token_expiry = datetime.now()
+            self.refresh_token_expiry = datetime.now()
+            raise
+
+    async def __perform_login_flow(self):
+        self.session_id = secrets.token_hex(15)
+        self.request_id = str(secrets.randbits(34) % 1000000000).zfill(9)
+
+        await self.__perform_request(Request_2_1(
+            self.client_id, self.client_secret, self.zugangsnummer, self.pin))
+
+        await self.__perform_request(Request_2_2(
+            self.access_token, self.session_id, self.request_id))
+
+        await self.__perform_request(Request_2_3(
+            self.access_token, self.session_id, self.request_id, self.session_UUID))
+
+        await self.__wait_for_challenge()
+        if self.challenge_status != 'AUTHENTICATED':
+            raise Exception(
+                'TAN challenge failed. Status was ' + self.challenge_status)
+
+        await self.__perform_request(Request_2_4(
+            self.access_token, self.session_id, self.request_id, self.session_UUID, self.challenge_id))
+
+        await self.__perform_request(Request_2_5(
+            self.client_id, self.client_secret, self.access_token))
+
+    async def __wait_for_challenge(self):
+        self.challenge_status = 'PENDING'
+        while self.challenge_status == 'PENDING':
+            await asyncio.sleep(3)
+            await self.__perform_request(Request_Challenge_Status(
+                self.access_token, self.session_id, self.request_id, self.challenge_status_endpoint))
+
+    async def __rate_limit(self):
+        if self.rate_limiter is not None:
+            wait = await asyncio.to_thread(self.rate_limiter.reserve)
+            if wait > 0:
+                _logger.debug('Rate limit reached. Waiting %.3f seconds', wait)
+                await asyncio.sleep(wait)
+            metrics.observe('comdirect_rate_limit_wait_seconds', wait, limiter='redis')
+            return
+        start = time.perf_counter()
+        await self.local_limit.acquire()
+        asyncio.get_running_loop().call_later(1, self.local_limit.release)
+        metrics.observe('comdirect_rate_limit_wait_seconds',
+                        time.perf_counter() - start, limiter='process')
+
+    async def __perform_request(self, request: Type[ComdirectRequest]):
+        await self.__rate_limit()
+        # The payload is either form encoded, JSON encoded or empty
+        content = request.payload if isinstance(request.payload, str) else None
+        name = type(request).__name__
+        with metrics.timer('comdirect_api_request_duration_seconds', request=name):
+            response = await self.client.request(request.method, request.endpoint,
+                                                 headers=request.headers, content=content)
+        metrics.inc('comdirect_api_responses', request=name, status=str(response.status_code))
+        if response.status_code not in request.accepted_response_codes:
+            raise Exception('Status code should be one of: ' + str(request.accepted_response_codes) +
+                            ', but was ' + str(response.status_code) + '. Response: ' + response.text)
+        return request.process_response(self, response)
@@ -0,0 +1,69 @@
+import logging
+
+_logger = logging.getLogger(__name__)
+
+
+class PendingTransactions:
+    """Documents waiting for a transaction matching run.
+
+    The web service adds the documents of every trigger to a redis set so
+    that a document triggered several times is only matched once. Only the
+    first trigger after a run schedules the next run which then takes all
+    documents added in the meantime at once. Documents of a failed run are
+    added again so that they are retried by a later run.
+    """
+
+    def __init__(self, redis_conn, window=10) -> None:
+        # window is the number of seconds the run is delayed to collect triggers
+        self.redis_conn = redis_conn
+        self.window = window
+        self.documents_key = 'pending_transactions:documents'
+        self.interactive_key = 'pending_transactions:interactive'
+        self.scheduled_key = 'pending_transactions:scheduled'
+        self.attempts_key = 'pending_transactions:attempts'
+
+    def add(self, documents, interactive):
+        # Returns True if the caller has to schedule a run for the documents
+        pipe = self.redis_conn.pipeline()
+        pipe.sadd(self.documents_key, *documents)
+        if interactive:
+            pipe.set(self.interactive_key, 1)
+        # The flag expires in case the scheduled run got lost
+        pipe.set(self.scheduled_key, 1, nx=True, ex=self.window + 300)
+        scheduled = pipe.execute()[-1]
+        return bool(scheduled)
+
+    def take(self):
+        # Removes and returns all pending documents. Triggers arriving after
+        # this will schedule a new run.
+        pipe = self.redis_conn.pipeline()
+        pipe.smembers(self.documents_key)
+        pipe.get(self.interactive_key)
+        pipe.delete(self.documents_key, self.interactive_key, self.scheduled_key)
+        documents, interactive, _ = pipe.execute()
+        documents = sorted((d.decode() for d in documents), key=int)
+        _logger.debug('Took %d pending documents', len(documents))
+        return documents, interactive is not None
+
+    def retry(self, documents, interactive, max_attempts):
+        # Adds documents of a failed run again unless they already failed
+        # max_attempts times. Returns the documents added again and whether
+        # the caller has to schedule a run for them.
+        pipe = self.redis_conn.pipeline()
+        for document in documents:
+            pipe.hincrby(self.attempts_key, document, 1)
+        attempts = pipe.execute()
+        retried = [d for d, a in zip(documents, attempts) if a < max_attempts]
+        given_up = [d for d, a in zip(documents, attempts) if a >= max_attempts]
+        if given_up:
+            _logger.error('Giving up on documents %s after %d attempts',
+                          ', '.join(given_up), max_attempts)
+            self.done(given_up)
+        if not retried:
+            return retried, False
+        return retried, self.add(retried, interactive)
+
+    def done(self, documents):
+        # Forgets the failed attempts of documents
+        if documents:
+            self.redis_conn.hdel(self.attempts_key, *documents)
@@ -0,0 +1,108 @@
+"""Local stand-in for the Comdirect REST API used by the benchmarks."""
+from datetime import date
+from datetime import timedelta
+from urllib.parse import parse_qs
+import json
+import random
+
+from benchmarks.fakeserver import FakeServer
+from benchmarks.matching_benchmark import synthetic_ledger
+
+
+class FakeComdirect(FakeServer):
+    """Serves the endpoints of the Request_* classes for a synthetic customer.
+
+    The ledger of transactions transactions is spread over accounts accounts,
+    the postbox holds documents messages of which a share of html_ratio are
+    HTML and the rest PDF. TAN challenges are approved immediately. Point the
+    client at the server by setting comdirect.API_URL to address.
+    """
+
+    SESSION = '9f1e6d2a-benchmark-session'
+    CHALLENGE = '17b0benchmark'
+
+    def __init__(self, latency=0.0, page_size=20, transactions=1000, accounts=1, documents=20,
+                 html_ratio=0.5, error_rate=0.0, error_status=503, seed=0) -> None:
+        super().__init__(latency, error_rate, error_status, seed)
+        self.page_size = page_size
+        self.accounts = ['ACCOUNT%02d' % n for n in range(accounts)]
+        self.transactions = {account: [] for account in self.accounts}
+        for i, tx in enumerate(synthetic_ledger(transactions, seed)):
+            tx['bookingStatus'] = 'BOOKED'
+            self.transactions[self.accounts[i % accounts]].append(tx)
+        rnd = random.Random(seed)
+        self.documents = []
+        self.contents = {}
+        for n in range(documents):
+            document_id = 'DOC%08d' % n
+            html = rnd.random() < html_ratio
+            self.documents.append({
+                'documentId': document_id,
+                'name': 'Postbox message %d' % n,
+                'dateCreation': (date.today() - timedelta(days=n)).isoformat(),
+                'mimeType': 'text/html' if html else 'application/pdf',
+                'deletable': True,
+                'advertisement': False,
+                'documentMetaData': {'archived': False, 'alreadyRead': False, 'predocumentExists': False},
+            })
+            if html:
+                self.contents[document_id] = ('<html><body><h1>Mitteilung %d</h1><p>%s</p></body></html>'
+                                              % (n, 'Lorem ipsum dolor sit amet. ' * 50))
+            else:
+                self.contents[document_id] = (b'%PDF-1.4\n% benchmark ' + document_id.encode()
+                                              + b'\n' + bytes(rnd.getrandbits(8) for _ in range(20000)))
+        self.refreshes = 0
+
+    def __tokens(self):
+        return {'access_token': 'access-benchmark', 'refresh_token': 'refresh-benchmark',
+                'token_type': 'bearer', 'expires_in': 599, 'scope': 'full'}
+
+    def __transactions(self, account, query):
+        txs = self.transactions[account]
+        if 'min-bookingDate' in query:
+            txs = [tx for tx in txs if tx['bookingDate'] >= query['min-bookingDate']]
+        if 'max-bookingDate' in query:
+            txs = [tx for tx in txs if tx['bookingDate'] <= query['max-bookingDate']]
+        first = int(query.get('paging-first', 0))
+        return {
+            'paging': {'index': first, 'matches': len(txs)},
+            'aggregated': {'bookingDateLatestTransaction': txs[0]['bookingDate'] if txs else date.today().isoformat()},
+            'values': txs[first:first + self.page_size],
+        }
+
+    def route(self, method, path, query, headers, body):
+        sessions = '/api/session/clients/user/v1/sessions'
+
+        if method == 'POST' and path == '/oauth/token':
+            form = {key: values[0] for key, values in parse_qs(body.decode()).items()}
+            if form.get('grant_type') == 'refresh_token':
+                with self.lock:
+                    self.refreshes += 1
+            return 200, self.__tokens(), {}
+        if method == 'GET' and path == sessions:
+            return 200, [{'identifier': self.SESSION, 'sessionTanActive': False, 'activated2FA': False}], {}
+        if method == 'POST' and path == sessions + '/' + self.SESSION + '/validate':
+            challenge = {'id': self.CHALLENGE, 'typ': 'P_TAN_PUSH', 'availableTypes': ['P_TAN_PUSH'],
+                         'link': {'href': '/api/session/v1/authentications/' + self.CHALLENGE}}
+            return 201, {}, {'x-once-authentication-info': json.dumps(challenge)}
+        if method == 'GET' and path == '/api/session/v1/authentications/' + self.CHALLENGE:
+            return 200, {'status': 'AUTHENTICATED'}, {}
+        if method == 'PATCH' and path == sessions + '/' + self.SESSION:
+            return 200, {'identifier': self.SESSION, 'sessionTanActive': True, 'activated2FA': True}, {}
+
+        if method == 'GET' and path == '/api/banking/clients/user/v2/accounts/balances':
+            values = [{'accountId': account, 'account': {'accountId': account},
+                       'balance': {'value': '1000.00', 'unit': 'EUR'}} for account in self.accounts]
+            return 200, {'paging': {'index': 0, 'matches': len(values)}, 'values': values}, {}
+        if method == 'GET' and path.startswith('/api/banking/v1/accounts/') and path.endswith('/transactions'):
+            account = path.split('/')[-2]
+            return 200, self.__transactions(account, query), {}
+
+        if method == 'GET' and path == '/api/messages/clients/user/v2/documents':
+            first = int(query.get('paging-first', 0))
+            return 200, {'paging': {'index': first, 'matches': len(self.documents)},
+                         'values': self.documents[first:first + self.page_size]}, {}
+        if method == 'GET' and path.startswith('/api/messages/v2/documents/'):
+            return 200, self.contents[path.split('/')[-1]], {}
+
+        return super().route(method, path, query, headers, body)
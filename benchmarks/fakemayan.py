@@ -0,0 +1,152 @@
+"""Local stand-in for the Mayan EDMS REST API used by the benchmarks."""
+import json
+
+from benchmarks.fakeserver import FakeServer
+from benchmarks.fakeserver import paginate
+
+
+class FakeMayan(FakeServer):
+    """Serves the catalogs, documents, metadata and tags the worker uses.
+
+    items generic entries are created in every collection for benchmarks of
+    the pagination. Use add_document_type(), add_tag() and add_document() to
+    set up the data the worker jobs expect.
+    """
+
+    COLLECTIONS = ('content_types', 'document_types', 'metadata_types', 'tags', 'documents')
+
+    def __init__(self, latency=0.0, page_size=10, items=100, error_rate=0.0, error_status=503, seed=0) -> None:
+        super().__init__(latency, error_rate, error_status, seed)
+        self.page_size = page_size
+        self.collections = {
+            name: [{'id': i, 'label': '%s %d' % (name, i), 'name': '%s_%d' % (name, i)}
+                   for i in range(1, items + 1)]
+            for name in self.COLLECTIONS
+        }
+        # document type id -> metadata types of the document type
+        self.document_type_metadata = {}
+        # document id -> metadata of the document
+        self.metadata = {}
+        # document id -> ids of the attached tags
+        self.attached_tags = {}
+        # ids of deleted documents
+        self.trashed = set()
+        self.uploaded_bytes = 0
+
+    @property
+    def url(self):
+        return self.address + '/api/v4/'
+
+    def __add(self, name, item):
+        with self.lock:
+            item['id'] = len(self.collections[name]) + 1
+            self.collections[name].append(item)
+            return item['id']
+
+    def __find(self, name, id):
+        return next(item for item in self.collections[name] if item['id'] == int(id))
+
+    def add_metadata_type(self, name):
+        for item in self.collections['metadata_types']:
+            if item['name'] == name:
+                return item['id']
+        return self.__add('metadata_types', {'name': name, 'label': name})
+
+    def add_document_type(self, label, metadata_types=()):
+        id = self.__add('document_types', {'label': label})
+        self.document_type_metadata[id] = [
+            {'id': n, 'required': False,
+             'metadata_type': self.__find('metadata_types', self.add_metadata_type(name))}
+            for n, name in enumerate(metadata_types, 1)
+        ]
+        return id
+
+    def add_tag(self, label):
+        return self.__add('tags', {'label': label})
+
+    def add_document(self, document_type, label, metadata={}):
+        document_type = next(item for item in self.collections['document_types']
+                             if item['label'] == document_type)
+        id = self.__add('documents', {
+            'label': label,
+            'document_type': {'id': document_type['id'], 'label': document_type['label']}
+        })
+        self.metadata[id] = []
+        for name, value in metadata.items():
+            self.__add_metadata(id, self.add_metadata_type(name), value)
+        return id
+
+    def __add_metadata(self, document_id, metadata_type_id, value):
+        with self.lock:
+            entries = self.metadata.setdefault(document_id, [])
+            entry = {'id': len(entries) + 1,
+                     'metadata_type': self.__find('metadata_types', metadata_type_id),
+                     'value': value}
+            entries.append(entry)
+            return entry
+
+    def __with_url(self, name, item):
+        return dict(item, url='%s%s/%d/' % (self.url, name, item['id']))
+
+    def route(self, method, path, query, headers, body):
+        parts = path.replace('/api/v4/', '', 1).strip('/').split('/')
+        page = int(query.get('page', 1))
+        url = self.url + '/'.join(parts) + '/'
+        data = json.loads(body) if body and headers.get('Content-Type', '').startswith('application/json') else None
+
+        if method == 'GET':
+            if len(parts) == 1 and parts[0] in self.collections:
+                items = [self.__with_url(parts[0], item) for item in self.collections[parts[0]]]
+                return 200, paginate(items, page, self.page_size, url), {}
+            if parts[0] == 'document_types' and parts[2:] == ['metadata_types']:
+                items = self.document_type_metadata.get(int(parts[1]), [])
+                return 200, paginate(items, page, self.page_size, url), {}
+            if parts[0] == 'documents' and len(parts) == 2:
+                return 200, self.__with_url('documents', self.__find('documents', parts[1])), {}
+            if parts[0] == 'documents' and parts[2:] == ['metadata']:
+                items = self.metadata.get(int(parts[1]), [])
+                return 200, paginate(items, page, self.page_size, url), {}
+            if parts[0] == 'tags' and parts[2:] == ['documents']:
+                items = [self.__with_url('documents', item) for item in self.collections['documents']
+                         if int(parts[1]) in self.attached_tags.get(item['id'], [])
+                         and item['id'] not in self.trashed]
+                return 200, paginate(items, page, self.page_size, url), {}
+
+        if method == 'POST':
+            if parts == ['auth', 'token', 'obtain']:
+                return 200, {'token': 'benchmark'}, {}
+            if parts == ['documents']:
+                document_type = self.__find('document_types', data['document_type_id'])
+                id = self.add_document(document_type['label'], data.get('label'))
+                return 201, self.__with_url('documents', self.__find('documents', id)), {}
+            if parts[0] == 'documents' and parts[2:] == ['metadata']:
+                entry = self.__add_metadata(int(parts[1]), data['metadata_type_id'], data['value'])
+                return 201, entry, {}
+            if parts[0] == 'documents' and parts[2:] == ['tags', 'attach']:
+                with self.lock:
+                    self.attached_tags.setdefault(int(parts[1]), []).append(data['tag'])
+                return 200, {}, {}
+            if parts[0] == 'documents' and parts[2:] == ['tags', 'remove']:
+                with self.lock:
+                    tags = self.attached_tags.get(int(parts[1]), [])
+                    if data['tag'] in tags:
+                        tags.remove(data['tag'])
+                return 200, {}, {}
+            if parts[0] == 'documents' and parts[2:] == ['files']:
+                with self.lock:
+                    self.uploaded_bytes += len(body)
+                return 202, {}, {}
+
+        if method == 'DELETE' and parts[0] == 'documents' and len(parts) == 2:
+            # Documents are moved to the trash
+            with self.lock:
+                self.trashed.add(self.__find('documents', parts[1])['id'])
+            return 202, {}, {}
+
+        if method == 'PUT' and parts[0] == 'documents' and parts[2] == 'metadata':
+            entry = next(entry for entry in self.metadata[int(parts[1])]
+                         if entry['id'] == int(parts[3]))
+            entry['value'] = data['value']
+            return 200, entry, {}
+
+        return super().route(method, path, query, headers, body)
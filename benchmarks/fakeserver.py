@@ -0,0 +1,125 @@
+"""Base of the local stand-ins for the APIs used by the benchmarks."""
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from urllib.parse import parse_qs
+from urllib.parse import urlsplit
+import json
+import random
+import threading
+import time
+
+
+class FakeServer:
+    """HTTP server on a free local port that answers with route().
+
+    Every request is delayed by latency seconds. A share of error_rate of
+    all requests is answered with error_status (e.g. 429 or 503) instead
+    to see how the clients cope with an overloaded API.
+    """
+
+    def __init__(self, latency=0.0, error_rate=0.0, error_status=503, seed=0) -> None:
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+        self.server = None
+
+    @property
+    def address(self):
+        host, port = self.server.server_address[:2]
+        return 'http://%s:%d' % (host, port)
+
+    def start(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.__handler())
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def reset_counters(self):
+        with self.lock:
+            self.requests = 0
+            self.errors = 0
+
+    def route(self, method, path, query, headers, body):
+        # Returns (status, body, headers). Dicts and lists are sent as JSON,
+        # str as text/html and bytes as application/pdf.
+        return 404, {'detail': 'Not found.'}, {}
+
+    def _inject_error(self):
+        with self.lock:
+            self.requests += 1
+            failed = self.error_rate > 0 and self.random.random() < self.error_rate
+            if failed:
+                self.errors += 1
+            return failed
+
+    def __handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, format, *args):
+                pass
+
+            def reply(self, status, body, headers):
+                content_type = 'application/json'
+                if isinstance(body, str):
+                    data = body.encode('utf-8')
+                    content_type = 'text/html; charset=utf-8'
+                elif isinstance(body, bytes):
+                    data = body
+                    content_type = 'application/pdf'
+                else:
+                    data = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(data)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def handle_request(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                time.sleep(fake.latency)
+                if fake._inject_error():
+                    return self.reply(fake.error_status, {'detail': 'Injected error.'},
+                                      {'Retry-After': '1'})
+                parts = urlsplit(self.path)
+                query = {key: values[0] for key, values in parse_qs(parts.query).items()}
+                try:
+                    status, data, headers = fake.route(
+                        self.command, parts.path, query, self.headers, body)
+                except (KeyError, IndexError, ValueError):
+                    status, data, headers = 404, {'detail': 'Not found.'}, {}
+                self.reply(status, data, headers)
+
+            do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = handle_request
+
+        return Handler
+
+
+def paginate(items, page, page_size, url):
+    # Mayan style pagination with absolute next and previous links
+    start = (page - 1) * page_size
+    end = start + page_size
+    return {
+        'count': len(items),
+        'next': '%s?page=%d' % (url, page + 1) if end < len(items) else None,
+        'previous': '%s?page=%d' % (url, page - 1) if page > 1 else None,
+        'results': items[start:end],
+    }
@@ -0,0 +1,108 @@
+"""Microbenchmark of the transaction matching on a synthetic ledger.
+
+Run from the repository root:
+
+    python -m benchmarks.matching_benchmark --transactions 100000 --documents 50
+"""
+from babel import numbers
+from datetime import date
+from datetime import timedelta
+import argparse
+import random
+import time
+
+import matching
+
+
+def synthetic_ledger(size, seed=0):
+    rnd = random.Random(seed)
+    today = date.today()
+    ledger = []
+    for i in range(size):
+        day = (today - timedelta(days=i * 365 // size)).isoformat()
+        ledger.append({
+            'reference': 'REF%08d' % i,
+            'bookingDate': day,
+            'valutaDate': day,
+            'amount': {'value': '-%d.%02d' % (rnd.randint(1, 2000), rnd.randint(0, 99)), 'unit': 'EUR'},
+            'remittanceInfo': '01Rechnung RE-%07d Kunde %05d     02Danke' % (i, rnd.randint(0, 99999)),
+        })
+    return ledger
+
+
+def pick_searches(ledger, count, seed=0):
+    rnd = random.Random(seed)
+    searches = []
+    for key in range(count):
+        tx = ledger[rnd.randrange(len(ledger))]
+        searches.append({
+            'key': key,
+            'invoice_amount': numbers.parse_decimal(tx['amount']['value'].replace('-', ''), locale='en_US'),
+            'invoice_number': tx['remittanceInfo'][12:22],
+            'invoice_date': tx['valutaDate'],
+        })
+    return searches
+
+
+def legacy_match(search, transactions):
+    # The linear scan that was used before the transaction index existed
+    for tx in transactions:
+        tx_amount = tx['amount']['value'].replace('-', '')
+        tx_amount_decimal = numbers.parse_decimal(tx_amount, locale='en_US')
+        if (tx_amount_decimal == search['invoice_amount']
+                and search['invoice_number'] in tx['remittanceInfo']):
+            return tx
+    return None
+
+
+def timed(function):
+    start = time.perf_counter()
+    result = function()
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--transactions', type=int, default=100000)
+    parser.add_argument('--documents', type=int, default=50)
+    parser.add_argument('--legacy-documents', type=int, default=3,
+                        help='documents matched with the legacy scan (it is slow)')
+    options = parser.parse_args()
+
+    ledger = synthetic_ledger(options.transactions)
+    searches = pick_searches(ledger, options.documents)
+    print('ledger: %d transactions, %d documents' % (len(ledger), len(searches)))
+
+    legacy_searches = searches[:options.legacy_documents]
+    elapsed, legacy = timed(lambda: [legacy_match(s, ledger) for s in legacy_searches])
+    if legacy_searches:
+        print('legacy scan:     %10.3f ms per document' % (elapsed * 1000 / len(legacy_searches)))
+
+    elapsed, index = timed(lambda: matching.TransactionIndex(ledger))
+    print('index build:     %10.3f ms' % (elapsed * 1000))
+
+    elapsed, found = timed(lambda: [
+        index.find(matching.to_cents(s['invoice_amount']), s['invoice_number'], unsigned=True)
+        for s in searches])
+    print('index find:      %10.3f ms per document' % (elapsed * 1000 / len(searches)))
+
+    batch = [matching.Search(s['key'], matching.to_cents(s['invoice_amount']),
+                             s['invoice_number'], None, True) for s in searches]
+    elapsed, results = timed(lambda: index.match_many(batch))
+    print('index match_many: %9.3f ms for all documents' % (elapsed * 1000))
+
+    elapsed, index = timed(lambda: matching.TransactionIndex(ledger, normalize_numbers=True))
+    print('normalized build: %9.3f ms' % (elapsed * 1000))
+    tolerant = [search._replace(tolerance=matching.tolerance_cents(search.cents, '0.50', 3))
+                for search in batch]
+    elapsed, tolerant_results = timed(lambda: index.match_many(tolerant))
+    print('tolerant match:   %9.3f ms for all documents (3%% tolerance)' % (elapsed * 1000))
+
+    assert all(tolerant_results[s['key']] is not None for s in searches)
+    assert all(tx is not None for tx in found)
+    assert all(results[s['key']] is not None for s in searches)
+    assert all(legacy[i] is found[i] for i in range(len(legacy)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,37 @@
+"""Benchmark of sequential and concurrent page retrieval in Mayan.all().
+
+Run from the repository root:
+
+    python -m benchmarks.mayan_benchmark --items 500 --page-size 10 --latency 0.05
+"""
+import argparse
+import time
+
+from benchmarks.fakemayan import FakeMayan
+import mayan
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--items', type=int, default=500)
+    parser.add_argument('--page-size', type=int, default=10)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 8, 16])
+    options = parser.parse_args()
+
+    with FakeMayan(options.latency, options.page_size, options.items) as fake:
+        m = mayan.Mayan(fake.url, pool_size=max(options.workers))
+        m.session = m._new_session()
+        expected = None
+        for workers in options.workers:
+            start = time.perf_counter()
+            results = m.all('tags', page_workers=workers)
+            elapsed = time.perf_counter() - start
+            if expected is None:
+                expected = results
+            assert results == expected
+            print('%2d workers: %8.3f s for %d items' % (workers, elapsed, len(results)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,220 @@
+"""Benchmark of the worker jobs against local fake Comdirect and Mayan servers.
+
+Runs transaction(), transactions_batch(), reconcile(), import_postbox() and keepalive()
+on a synthetic dataset and reports throughput, latency and the number of
+requests sent to both APIs. Run from the repository root:
+
+    python -m benchmarks.worker_benchmark --transactions 5000 --documents 50 --latency 0.02
+
+The worker keeps its state in redis. The database given by --redis is
+flushed before the benchmark so don't point it to a database in use.
+"""
+from decimal import Decimal
+import argparse
+import json
+import os
+import random
+import re
+import shutil
+import statistics
+import tempfile
+import time
+
+from babel import numbers
+import redis
+
+from benchmarks.fakecomdirect import FakeComdirect
+from benchmarks.fakemayan import FakeMayan
+
+LOGGING = """[loggers]
+keys=root
+
+[handlers]
+keys=consoleHandler
+
+[formatters]
+keys=simpleFormat
+
+[handler_consoleHandler]
+class=StreamHandler
+level=NOTSET
+formatter=simpleFormat
+args=(sys.stderr,)
+
+[formatter_simpleFormat]
+format=%(asctime)s %(name)-12s %(levelname)-8s %(message)s
+
+[logger_root]
+level=CRITICAL
+handlers=consoleHandler
+"""
+
+
+def write_config(directory):
+    # The repository config with a logging config that works outside the container
+    shutil.copy(os.path.join(os.path.dirname(__file__), '..', 'config', 'config.json'), directory)
+    with open(os.path.join(directory, 'logging.ini'), 'w') as file:
+        file.write(LOGGING)
+    with open(os.path.join(directory, 'config.json')) as file:
+        return json.load(file)
+
+
+def setup_mayan(fake, config, fake_comdirect, documents, match_ratio, seed=0):
+    # Creates the catalog the config refers to and invoices of which a
+    # share of match_ratio corresponds to a transaction of the ledger
+    matching = config['transaction']['matching']
+    invoice_metadata = [matching[key]['metadatatype']
+                        for key in ('invoice_amount', 'invoice_number', 'invoice_date')]
+    invoice_metadata += list(config['transaction']['mapping'].values())
+    fake.add_document_type('Invoice', invoice_metadata)
+    fake.add_document_type(config['postbox']['documenttype'], list(config['postbox']['mapping'].values()))
+    tagging = config['transaction']['tagging']
+    for tag in tagging['success'] + tagging['failure']:
+        fake.add_tag(tag)
+
+    rnd = random.Random(seed)
+    ledger = [tx for txs in fake_comdirect.transactions.values() for tx in txs]
+    ids = []
+    for n in range(documents):
+        tx = rnd.choice(ledger)
+        amount = abs(Decimal(tx['amount']['value']))
+        number = re.search(r'RE-\d+', tx['remittanceInfo']).group(0)
+        if rnd.random() >= match_ratio:
+            amount += 1
+            number = 'XX-%07d' % n
+        valuta = time.strptime(tx['valutaDate'], '%Y-%m-%d')
+        metadata = {
+            matching['invoice_amount']['metadatatype']: numbers.format_decimal(
+                amount, format='#,##0.00', locale=matching['invoice_amount']['locale']) + ' EUR',
+            matching['invoice_number']['metadatatype']: number,
+            matching['invoice_date']['metadatatype']: time.strftime(
+                matching['invoice_date']['dateformat'], valuta),
+        }
+        ids.append(str(fake.add_document('Invoice', 'Invoice %d' % n, metadata)))
+    return ids
+
+
+def measure(name, runs, job, fakes):
+    for fake in fakes:
+        fake.reset_counters()
+    durations = []
+    failures = []
+    start = time.perf_counter()
+    for args in runs:
+        begin = time.perf_counter()
+        try:
+            job(*args)
+        except Exception as e:
+            failures.append(e)
+        durations.append(time.perf_counter() - begin)
+    total = time.perf_counter() - start
+    durations.sort()
+    print('%-26s %4d runs %4d failed %8.3f s %8.1f runs/s | mean %7.3f p50 %7.3f p95 %7.3f max %7.3f s | '
+          'comdirect %5d req %4d err | mayan %5d req %4d err' % (
+              name, len(runs), len(failures), total, len(runs) / total if total else 0,
+              statistics.mean(durations), durations[len(durations) // 2],
+              durations[int(len(durations) * 0.95)], durations[-1],
+              fakes[0].requests, fakes[0].errors, fakes[1].requests, fakes[1].errors))
+    if failures:
+        print('    first failure: %r' % failures[0])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--transactions', type=int, default=5000)
+    parser.add_argument('--accounts', type=int, default=2)
+    parser.add_argument('--documents', type=int, default=50, help='invoices in Mayan EDMS')
+    parser.add_argument('--match-ratio', type=float, default=0.8)
+    parser.add_argument('--postbox', type=int, default=20, help='messages in the Comdirect postbox')
+    parser.add_argument('--html-ratio', type=float, default=None,
+                        help='share of HTML postbox messages (defaults to 0.5 if wkhtmltopdf is installed, else 0)')
+    parser.add_argument('--page-size', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.02)
+    parser.add_argument('--errors', type=float, default=0.0, help='share of requests answered with an error')
+    parser.add_argument('--error-status', type=int, default=503)
+    parser.add_argument('--iterations', type=int, default=5)
+    parser.add_argument('--jobs', nargs='+',
+                        default=['transaction', 'transactions_batch', 'reconcile', 'import_postbox', 'keepalive'])
+    parser.add_argument('--redis', default='redis://localhost:6379/15')
+    options = parser.parse_args()
+
+    html_ratio = options.html_ratio
+    if html_ratio is None:
+        html_ratio = 0.5 if shutil.which('wkhtmltopdf') else 0.0
+        if not html_ratio:
+            print('wkhtmltopdf not found. The postbox only contains PDF messages.')
+
+    config_dir = tempfile.mkdtemp()
+    fake_comdirect = FakeComdirect(options.latency, options.page_size, options.transactions, options.accounts,
+                                   options.postbox, html_ratio, error_status=options.error_status)
+    fake_mayan = FakeMayan(options.latency, options.page_size, 0, error_status=options.error_status)
+    with fake_comdirect, fake_mayan:
+        config = write_config(config_dir)
+        invoices = setup_mayan(fake_mayan, config, fake_comdirect, options.documents, options.match_ratio)
+        os.environ.pop('OIDC_URL', None)
+        os.environ.update({
+            'REDIS_URL': options.redis,
+            'REDIS_CACHE_URL': options.redis,
+            'CONFIG_DIR': config_dir,
+            'MAYAN_URL': fake_mayan.url,
+            'MAYAN_USER': 'benchmark',
+            'MAYAN_PASSWORD': 'benchmark',
+            'COMDIRECT_CLIENT_ID': 'benchmark',
+            'COMDIRECT_CLIENT_SECRET': 'benchmark',
+            'COMDIRECT_ZUGANGSNUMMER': 'benchmark',
+            'COMDIRECT_PIN': 'benchmark',
+        })
+        redis.from_url(options.redis).flushdb()
+        # The worker modules (and metrics) read their configuration on import
+        import comdirect
+        import comdirectworker as worker
+        comdirect.API_URL = fake_comdirect.address
+
+        print('Logging in (the fake server approves the TAN challenge)')
+        worker.get_comdirect(worker.get_comdirect_options()).login(True)
+        fake_comdirect.error_rate = options.errors
+        fake_mayan.error_rate = options.errors
+        fakes = [fake_comdirect, fake_mayan]
+
+        def clear_transactions():
+            for key in worker.redis_conn.scan_iter(match='transaction_cache:*'):
+                worker.redis_conn.delete(key)
+
+        if 'transaction' in options.jobs:
+            clear_transactions()
+            measure('transaction', [(invoice, False) for invoice in invoices], worker.transaction, fakes)
+        if 'transactions_batch' in options.jobs:
+            clear_transactions()
+            measure('transactions_batch', [(invoices, False)], worker.transactions_batch, fakes)
+        if 'reconcile' in options.jobs:
+            def reconcile():
+                # All invoices are open and matched against all transactions
+                clear_transactions()
+                worker.redis_conn.delete(worker.reconciliation_state.key)
+                for tag in config['transaction']['tagging']['failure']:
+                    tag_id = next(item['id'] for item in fake_mayan.collections['tags'] if item['label'] == tag)
+                    for invoice in invoices:
+                        fake_mayan.attached_tags[int(invoice)] = [tag_id]
+                worker.reconcile(False)
+            measure('reconcile', [()] * options.iterations, reconcile, fakes)
+        if 'import_postbox' in options.jobs:
+            def import_postbox():
+                for key in worker.redis_conn.scan_iter(match='postbox_index:*'):
+                    worker.redis_conn.delete(key)
+                worker.import_postbox(False, False, False, False)
+            measure('import_postbox', [()] * options.iterations, import_postbox, fakes)
+            measure('import_postbox (imported)', [(False, False, False, False)] * options.iterations,
+                    worker.import_postbox, fakes)
+        if 'keepalive' in options.jobs:
+            def keepalive():
+                # Let the access token expire so that every run refreshes the session
+                worker.comdirect_state.redis_conn.hset(worker.comdirect_state.key, 'access_token_expiry',
+                                                       '2000-01-01T00:00:00')
+                worker.keepalive()
+            measure('keepalive', [()] * options.iterations, keepalive, fakes)
+
+    shutil.rmtree(config_dir)
+
+
+if __name__ == '__main__':
+    main()
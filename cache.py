@@ -0,0 +1,286 @@
+from datetime import datetime
+from datetime import timedelta
+import json
+import logging
+import metrics
+import redis_lock
+
+_logger = logging.getLogger(__name__)
+
+
+def transaction_key(tx):
+    # Booked transactions carry a unique reference. Fall back to the full
+    # content for the rare case where it is missing.
+    reference = tx.get('reference')
+    if reference:
+        return reference
+    return json.dumps(tx, sort_keys=True)
+
+
+def merge_transactions(*transaction_lists):
+    merged = []
+    seen = set()
+    for transactions in transaction_lists:
+        for tx in transactions:
+            key = transaction_key(tx)
+            if key not in seen:
+                seen.add(key)
+                merged.append(tx)
+    return merged
+
+
+def filter_transactions(transactions, earliest):
+    filtered = []
+    for tx in transactions:
+        if tx.get('valutaDate'):
+            if datetime.strptime(tx['valutaDate'], '%Y-%m-%d') < earliest:
+                continue
+        filtered.append(tx)
+    return filtered
+
+
+def latest_booking_date(transactions):
+    dates = [tx['bookingDate'] for tx in transactions if tx.get('bookingDate')]
+    if not dates:
+        return None
+    return datetime.strptime(max(dates), '%Y-%m-%d')
+
+
+class CachedTransactions:
+
+    def __init__(self, earliest, latest, fetched, transactions) -> None:
+        # earliest: lower bound of the valuta date window covered by the cache
+        # latest: booking date of the newest cached transaction (may be None)
+        # fetched: time of the last successful synchronization with comdirect
+        self.earliest = earliest
+        self.latest = latest
+        self.fetched = fetched
+        self.transactions = transactions
+
+    def covers(self, earliest):
+        return self.earliest <= earliest
+
+    def is_fresh(self, max_age):
+        return self.fetched + timedelta(seconds=max_age) > datetime.now()
+
+
+class TransactionCache:
+
+    def __init__(self, redis_conn, ttl=24 * 60 * 60) -> None:
+        self.redis_conn = redis_conn
+        self.ttl = ttl
+        # The accounts of the last synchronization. They are kept as long as
+        # the transactions because the comdirect session state expires earlier.
+        self.accounts_key = 'transaction_cache_accounts'
+
+    def __key(self, account):
+        return 'transaction_cache:' + account
+
+    def get(self, account):
+        if not account:
+            return None
+        cached = self.redis_conn.get(self.__key(account))
+        if cached is None:
+            _logger.debug('No cached transactions for account %s', account)
+            metrics.inc('comdirect_cache_lookups', cache='transactions', result='miss')
+            return None
+        metrics.inc('comdirect_cache_lookups', cache='transactions', result='hit')
+        try:
+            data = json.loads(cached)
+            latest = None
+            if data['latest']:
+                latest = datetime.strptime(data['latest'], '%Y-%m-%d')
+            return CachedTransactions(
+                datetime.strptime(data['earliest'], '%Y-%m-%d'),
+                latest,
+                datetime.fromisoformat(data['fetched']),
+                data['transactions'])
+        except (ValueError, KeyError):
+            _logger.warning(
+                'Discarding unreadable transaction cache for account %s', account)
+            self.invalidate(account)
+            return None
+
+    def set(self, account, earliest, transactions):
+        if not account:
+            return
+        latest = latest_booking_date(transactions)
+        data = {
+            'earliest': earliest.strftime('%Y-%m-%d'),
+            'latest': latest.strftime('%Y-%m-%d') if latest else None,
+            'fetched': datetime.now().isoformat(),
+            'transactions': transactions
+        }
+        pipe = self.redis_conn.pipeline()
+        pipe.set(self.__key(account), json.dumps(data), self.ttl)
+        pipe.set(self.accounts_key, account, self.ttl)
+        pipe.execute()
+        _logger.debug('Cached %d transactions for account %s',
+                      len(transactions), account)
+
+    def invalidate(self, account):
+        self.redis_conn.delete(self.__key(account))
+
+    def get_accounts(self):
+        accounts = self.redis_conn.get(self.accounts_key)
+        if accounts is None:
+            return None
+        return accounts.decode()
+
+
+class CatalogCache:
+
+    def __init__(self, redis_conn, ttl=60 * 60) -> None:
+        self.redis_conn = redis_conn
+        self.ttl = ttl
+
+    def __key(self, baseurl, name):
+        return 'mayan_catalog:' + baseurl + ':' + name
+
+    def get(self, baseurl, name):
+        cached = self.redis_conn.get(self.__key(baseurl, name))
+        if cached is None:
+            _logger.debug('Mayan catalog %s not cached', name)
+            metrics.inc('comdirect_cache_lookups', cache='mayan_catalog', result='miss')
+            return None
+        metrics.inc('comdirect_cache_lookups', cache='mayan_catalog', result='hit')
+        return json.loads(cached)
+
+    def set(self, baseurl, name, value):
+        self.redis_conn.set(self.__key(baseurl, name), json.dumps(value), self.ttl)
+
+    def invalidate(self, baseurl=None):
+        pattern = 'mayan_catalog:*'
+        if baseurl:
+            pattern = 'mayan_catalog:' + baseurl + ':*'
+        keys = list(self.redis_conn.scan_iter(match=pattern))
+        if keys:
+            self.redis_conn.delete(*keys)
+        _logger.info('Invalidated %d cached mayan catalog entries', len(keys))
+
+
+class TokenCache:
+
+    def __init__(self, redis_conn, ttl=24 * 60 * 60, margin=60) -> None:
+        # ttl is used for tokens without expiry, margin is the time
+        # before the expiry at which a token is no longer handed out
+        self.redis_conn = redis_conn
+        self.ttl = ttl
+        self.margin = margin
+
+    def __key(self, key):
+        return 'mayan_token:' + key
+
+    def get(self, key):
+        cached = self.redis_conn.get(self.__key(key))
+        if cached is None:
+            metrics.inc('comdirect_cache_lookups', cache='mayan_token', result='miss')
+            return None
+        data = json.loads(cached)
+        expiry = datetime.fromisoformat(data['expiry'])
+        if expiry - timedelta(seconds=self.margin) <= datetime.now():
+            _logger.debug('Cached mayan token is about to expire')
+            metrics.inc('comdirect_cache_lookups', cache='mayan_token', result='miss')
+            return None
+        metrics.inc('comdirect_cache_lookups', cache='mayan_token', result='hit')
+        return data['authorization']
+
+    def set(self, key, authorization, expires_in=None):
+        ttl = expires_in if expires_in else self.ttl
+        data = {
+            'authorization': authorization,
+            'expiry': (datetime.now() + timedelta(seconds=ttl)).isoformat()
+        }
+        self.redis_conn.set(self.__key(key), json.dumps(data), ttl)
+
+    def lock(self, key):
+        # Makes sure only one worker at a time obtains a new token
+        return redis_lock.Lock(self.redis_conn, name=self.__key(key),
+                               expire=60, auto_renewal=True)
+
+
+class PostboxIndex:
+    """Persistent record of the postbox documents imported into mayan."""
+
+    def __init__(self, redis_conn) -> None:
+        self.redis_conn = redis_conn
+
+    def contains(self, document_id):
+        return self.redis_conn.hexists('postbox_index:documents', document_id)
+
+    def find_hash(self, content_hash):
+        mayan_id = self.redis_conn.hget('postbox_index:hashes', content_hash)
+        if mayan_id is None:
+            return None
+        return int(mayan_id)
+
+    def add(self, document_id, content_hash, mayan_id):
+        data = {'hash': content_hash, 'mayan_id': mayan_id}
+        pipe = self.redis_conn.pipeline()
+        pipe.hset('postbox_index:documents', document_id, json.dumps(data))
+        if content_hash:
+            pipe.hsetnx('postbox_index:hashes', content_hash, mayan_id)
+        pipe.execute()
+
+
+class ReconciliationState:
+    """Time of the last successful reconciliation run."""
+
+    def __init__(self, redis_conn) -> None:
+        self.redis_conn = redis_conn
+        self.key = 'reconciliation:last_run'
+
+    def get(self):
+        value = self.redis_conn.get(self.key)
+        if value is None:
+            return None
+        return datetime.fromisoformat(value.decode())
+
+    def set(self, last_run):
+        self.redis_conn.set(self.key, last_run.isoformat())
+
+
+class ComdirectStateCache:
+    """Session state of the comdirect API shared by all workers.
+
+    The state is kept in a redis hash with one field per value of
+    Comdirect.STATE_FIELDS so that single values can be read and written
+    without touching the rest of the state.
+    """
+
+    def __init__(self, redis_conn, ttl=20 * 60) -> None:
+        # We need to log in again after 20 minutes anyway
+        # so we might as well clear the cache after 20 minutes
+        self.redis_conn = redis_conn
+        self.ttl = ttl
+        self.key = 'comdirect_state'
+
+    def lock(self):
+        return redis_lock.Lock(self.redis_conn, name='api_lock', expire=15, auto_renewal=True)
+
+    def get(self, *names):
+        if names:
+            values = self.redis_conn.hmget(self.key, names)
+            return {name: value.decode() for name, value in zip(names, values)
+                    if value is not None}
+        return {name.decode(): value.decode()
+                for name, value in self.redis_conn.hgetall(self.key).items()}
+
+    def load(self, comdirect):
+        comdirect.set_state(self.get())
+
+    def save(self, comdirect):
+        pipe = self.redis_conn.pipeline()
+        pipe.delete(self.key)
+        state = comdirect.get_state()
+        if state:
+            pipe.hset(self.key, mapping=state)
+            pipe.expire(self.key, self.ttl)
+        pipe.execute()
+
+    def update(self, comdirect, *names):
+        # Writes single values without overwriting tokens that
+        # may have been refreshed by another process
+        state = comdirect.get_state(*names)
+        if state:
+            self.redis_conn.hset(self.key, mapping=state)
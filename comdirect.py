@@ -1,17 +1,55 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from datetime import timedelta
 from limit import limit
 from typing import Type
 import json
 import logging
+import metrics
 import requests
 import secrets
 import time
 
 _logger = logging.getLogger(__name__)
 
+# Base URL of all requests. Only changed to run against a local stand-in.
+API_URL = 'https://api.comdirect.de'
+
+
+def filter_account_page(account_UUID, txs, earliest, latest=None):
+    # Tags the transactions of a page with their account and drops those
+    # outside of the window in case the date filters were not applied
+    transactions = []
+    for tx in txs:
+        tx['accountId'] = account_UUID
+        if latest and tx.get('bookingDate') and tx['bookingDate'] > latest.strftime('%Y-%m-%d'):
+            continue
+        if tx['valutaDate']:
+            valuta_date = datetime.strptime(tx['valutaDate'], '%Y-%m-%d')
+            if valuta_date < earliest:
+                continue
+        transactions.append(tx)
+    return transactions
+
+
+def passed_window(txs, stop):
+    # Transactions are ordered by booking date with the newest first so
+    # no later page can be in the window once a page reaches beyond stop
+    booking_dates = [tx['bookingDate'] for tx in txs if tx.get('bookingDate')]
+    return bool(booking_dates) and min(booking_dates) < stop.strftime('%Y-%m-%d')
+
+
+def merge_accounts(results):
+    # Merges the transactions of several accounts into one list that is
+    # ordered like the transactions of a single account (newest first)
+    transactions = [tx for account_transactions in results for tx in account_transactions]
+    transactions.sort(key=lambda tx: tx.get('bookingDate') or '', reverse=True)
+    return transactions
+
 
 class ComdirectRequest():
+    # Streamed responses are not read before they are returned
+    stream = False
 
     def process_response(self, comdirect, response):
         _logger.debug(response.text)
@@ -35,19 +73,116 @@ class Comdirect:
         self.pin = pin
         self.access_token_expiry = datetime.now()
         self.refresh_token_expiry = datetime.now()
+        self.session = requests.Session()
+        # Optional limiter shared with other processes. See ratelimit.py
+        self.rate_limiter = None
+        # Optional store that shares the session state with other processes.
+        # It provides lock() as well as load(comdirect) and save(comdirect).
+        self.state_store = None
+
+    # Everything that is required to continue a session in another process
+    STATE_FIELDS = ('access_token', 'refresh_token', 'access_token_expiry', 'refresh_token_expiry',
+                    'session_id', 'request_id', 'session_UUID', 'account_UUID', 'account_UUIDs')
+    STATE_DATETIME_FIELDS = ('access_token_expiry', 'refresh_token_expiry')
+    STATE_LIST_FIELDS = ('account_UUIDs',)
+
+    def get_state(self, *names):
+        state = {}
+        for name in names or self.STATE_FIELDS:
+            value = getattr(self, name, None)
+            if value is None:
+                continue
+            if name in self.STATE_DATETIME_FIELDS:
+                value = value.isoformat()
+            if name in self.STATE_LIST_FIELDS:
+                value = ','.join(value)
+            state[name] = value
+        return state
+
+    def set_state(self, state):
+        for name, value in state.items():
+            if name not in self.STATE_FIELDS:
+                continue
+            if name in self.STATE_DATETIME_FIELDS:
+                value = datetime.fromisoformat(value)
+            if name in self.STATE_LIST_FIELDS:
+                value = value.split(',')
+            setattr(self, name, value)
+
+    # Access tokens that expire within this number of seconds are refreshed
+    # so that they don't expire while requests are performed with them
+    TOKEN_MIN_VALIDITY = 60
+
+    def is_logged_in(self, min_validity=0) -> bool:
+        return self.access_token_expiry > datetime.now() + timedelta(seconds=min_validity)
 
     def login(self, interactive) -> bool:
-        try:
-            if self.access_token_expiry > datetime.now():
-                _logger.debug("Access token is still valid")
+        if self.is_logged_in(self.TOKEN_MIN_VALIDITY):
+            _logger.debug("Access token is still valid")
+            return True
+
+        state_store = getattr(self, 'state_store', None)
+        if state_store is None:
+            return self.__login(interactive)
+
+        # Only changes of the session state have to be serialized.
+        # Requests with a valid access token may run concurrently.
+        with metrics.locked(state_store.lock(), 'comdirect_api_lock_wait_seconds'):
+            # Another process may have refreshed the tokens in the meantime
+            state_store.load(self)
+            if self.is_logged_in(self.TOKEN_MIN_VALIDITY):
+                _logger.debug("Access token was refreshed by another process")
                 return True
+            # A failed login only invalidates the tokens of this process.
+            # Saving it would end the session of all other processes.
+            logged_in = self.__login(interactive)
+            state_store.save(self)
+            return logged_in
+
+    def refresh_session(self, lead=None) -> bool:
+        # Refreshes the tokens even if the access token is still valid
+        # which extends the session by another 20 minutes. With lead
+        # (in seconds) the tokens are only refreshed if the refresh token
+        # expires within lead seconds, so that concurrent callers refresh
+        # the session only once.
+        state_store = getattr(self, 'state_store', None)
+        if state_store is None:
+            return self.__refresh_session()
+        with metrics.locked(state_store.lock(), 'comdirect_api_lock_wait_seconds'):
+            state_store.load(self)
+            if lead is not None and self.refresh_token_expiry - datetime.now() > timedelta(seconds=lead):
+                _logger.debug("Session was refreshed by another process")
+                return False
+            refreshed = self.__refresh_session()
+            state_store.save(self)
+            return refreshed
+
+    def __refresh_session(self) -> bool:
+        if self.refresh_token_expiry <= datetime.now():
+            _logger.info("Refresh token is no longer valid. Session can't be refreshed.")
+            return False
+        try:
+            self.__perform_token_refresh()
+            return True
+        except:
+            _logger.error("Token refresh failed. Invalidating tokens.")
+            self.access_token_expiry = datetime.now()
+            self.refresh_token_expiry = datetime.now()
+            raise
 
+    def __login(self, interactive) -> bool:
+        try:
             if self.refresh_token_expiry > datetime.now():
                 _logger.debug(
                     "Refresh token is still valid. Performing access token refresh")
                 self.__perform_token_refresh()
                 return True
 
+            if self.is_logged_in():
+                _logger.debug(
+                    "Access token is about to expire but can't be refreshed")
+                return True
+
             if not interactive:
                 _logger.info(
                     "Tokens are no longer valid. Login with TAN not performed in non-interactive mode")
@@ -62,7 +197,11 @@ class Comdirect:
             self.refresh_token_expiry = datetime.now()
             raise
 
-    def get_transactions(self, earliest, interactive):
+    def get_transactions(self, earliest, interactive, newer_than=None, latest=None):
+        # Transactions are filtered by their valuta date against earliest.
+        # Only transactions booked between earliest (or newer_than if given)
+        # and latest are requested so the cost depends on the size of the
+        # window and not on its distance from today.
         if not self.login(interactive):
             _logger.info('Not logged in. Stopping get_transactions.')
             return []
@@ -71,33 +210,14 @@ class Comdirect:
             self.__perform_request(Request_4_1_1(
                 self.access_token, self.session_id, self.request_id))
 
-            transactions = []
-            booking_date_latest_transaction = datetime.now()
-            paging_first = 0
-
-            while booking_date_latest_transaction >= earliest:
-                response = self.__perform_request(Request_4_1_3(
-                    self.access_token, self.session_id, self.request_id, self.account_UUID, paging_first))
-                json = response.json()
-                booking_date_latest_transaction = datetime.strptime(
-                    json['aggregated']['bookingDateLatestTransaction'], '%Y-%m-%d')
-                txs = json['values']
-
-                for tx in txs:
-                    if tx['valutaDate']:
-                        valuta_date = datetime.strptime(
-                            tx['valutaDate'], '%Y-%m-%d')
-                        if valuta_date >= earliest:
-                            transactions.append(tx)
-                    else:
-                        transactions.append(tx)
-
-                paging_first += 1
-                
-                if json['paging']['matches'] == paging_first:
-                    break
-
-            return transactions
+            stop = newer_than if newer_than else earliest
+            # Paging of each account is independent so the accounts
+            # are processed concurrently within the rate limit
+            with ThreadPoolExecutor(max_workers=len(self.account_UUIDs)) as executor:
+                results = executor.map(
+                    lambda account_UUID: self.__get_account_transactions(account_UUID, earliest, stop, latest),
+                    self.account_UUIDs)
+                return merge_accounts(results)
 
         except:
             _logger.error(
@@ -106,24 +226,55 @@ class Comdirect:
             self.refresh_token_expiry = datetime.now()
             raise
 
+    def __get_account_transactions(self, account_UUID, earliest, stop, latest):
+        transactions = []
+        paging_first = 0
+
+        while True:
+            response = self.__perform_request(Request_4_1_3(
+                self.access_token, self.session_id, self.request_id, account_UUID, paging_first, stop, latest))
+            json = response.json()
+            txs = json['values']
+            if not txs:
+                break
+
+            transactions += filter_account_page(account_UUID, txs, earliest, latest)
+            paging_first += len(txs)
+
+            if paging_first >= json['paging']['matches'] or passed_window(txs, stop):
+                break
+
+        return transactions
+
     def get_postbox_documents(self, interactive, get_ads=False, get_archived=False, get_read=False):
+        return list(self.iter_postbox_documents(interactive, get_ads, get_archived, get_read))
+
+    def iter_postbox_documents(self, interactive, get_ads=False, get_archived=False, get_read=False, skip=None, stream=False, before_stream=None):
+        # Yields the documents one at a time so that only a single
+        # document content has to be held in memory. Documents for which
+        # skip(document) returns True are not downloaded at all.
+        # With stream=True PDF documents carry the unread download in
+        # 'response' instead of their 'content'. before_stream() is called
+        # right before such a download is opened and may block until the
+        # caller is ready to read it.
         if not self.login(interactive):
             _logger.info('Not logged in. Stopping get_postbox_documents.')
-            return []
+            return
 
         try:
-            documents = []
             paging_first = 0
-            matches = 999
+            matches = 1
 
-            while(paging_first < matches - 1):
+            while paging_first < matches:
                 documentsResponse = self.__perform_request(Request_9_1_1(
                     self.access_token, self.session_id, self.request_id, paging_first))
 
                 responseJson = documentsResponse.json()
                 documentsJson = responseJson['values']
-                paging_first += len(documentsJson) - 1
+                paging_first += len(documentsJson)
                 matches = responseJson['paging']['matches']
+                if len(documentsJson) == 0:
+                    break
 
                 for document in documentsJson:
                     filtered = document['advertisement'] and not get_ads
@@ -133,18 +284,22 @@ class Comdirect:
                     filtered = filtered or (
                         document['documentMetaData']['alreadyRead'] and not get_read
                     )
+                    filtered = filtered or (skip is not None and skip(document))
                     if not (filtered):
                         mimetype = document['mimeType']
                         document_UUID = document['documentId']
+                        streamed = stream and mimetype == 'application/pdf'
+                        if streamed and before_stream is not None:
+                            before_stream()
                         response = self.__perform_request(Request_9_1_2(
-                            self.access_token, self.session_id, self.request_id, document_UUID, mimetype))
+                            self.access_token, self.session_id, self.request_id, document_UUID, mimetype, streamed))
                         if mimetype == 'text/html':
                             document['content'] = response.text
-                        if mimetype == 'application/pdf':
+                        if streamed:
+                            document['response'] = response
+                        elif mimetype == 'application/pdf':
                             document['content'] = response.content
-                        documents.append(document)
-
-            return documents
+                        yield document
 
         except:
             _logger.error(
@@ -196,11 +351,25 @@ class Comdirect:
             self.__perform_request(Request_Challenge_Status(
                 self.access_token, self.session_id, self.request_id, self.challenge_status_endpoint))
 
-    # API terms of use allow a maxmimum of 10 requests per second
-    @limit(10)
+    # API terms of use allow a maxmimum of 10 requests per second.
     def __perform_request(self, request: Type[ComdirectRequest]):
-        response = self.session.request(request.method, request.endpoint,
-                                        headers=request.headers, data=request.payload)
+        return self.__send_request(request, time.perf_counter())
+
+    # The decorator only limits this process, the rate limiter
+    # enforces the limit for all workers.
+    @limit(10)
+    def __send_request(self, request: Type[ComdirectRequest], queued):
+        metrics.observe('comdirect_rate_limit_wait_seconds',
+                        time.perf_counter() - queued, limiter='process')
+        if getattr(self, 'rate_limiter', None) is not None:
+            metrics.observe('comdirect_rate_limit_wait_seconds',
+                            self.rate_limiter.acquire(), limiter='redis')
+        name = type(request).__name__
+        with metrics.timer('comdirect_api_request_duration_seconds', request=name):
+            response = self.session.request(request.method, request.endpoint,
+                                            headers=request.headers, data=request.payload,
+                                            stream=request.stream)
+        metrics.inc('comdirect_api_responses', request=name, status=str(response.status_code))
         if response.status_code not in request.accepted_response_codes:
             raise Exception('Status code should be one of: ' + str(request.accepted_response_codes) +
                             ', but was ' + str(response.status_code) + '. Response: ' + response.text)
@@ -212,7 +381,7 @@ class Comdirect:
 class Request_2_1(ComdirectRequest):
     def __init__(self, client_id, client_secret, zugangsnummer, pin):
         self.method = 'POST'
-        self.endpoint = "https://api.comdirect.de/oauth/token"
+        self.endpoint = API_URL + "/oauth/token"
         self.payload = 'client_id=' + client_id + '&client_secret=' + client_secret + \
             '&grant_type=password&username=' + zugangsnummer + '&password=' + pin
         self.headers = {
@@ -231,7 +400,7 @@ class Request_2_1(ComdirectRequest):
 class Request_2_2(ComdirectRequest):
     def __init__(self, access_token, session_id, request_id):
         self.method = 'GET'
-        self.endpoint = 'https://api.comdirect.de/api/session/clients/user/v1/sessions'
+        self.endpoint = API_URL + '/api/session/clients/user/v1/sessions'
         self.payload = {}
         self.headers = {
             'Accept': 'application/json',
@@ -252,7 +421,7 @@ class Request_2_2(ComdirectRequest):
 class Request_2_3(ComdirectRequest):
     def __init__(self, access_token, session_id, request_id, session_UUID):
         self.method = 'POST'
-        self.endpoint = 'https://api.comdirect.de/api/session/clients/user/v1/sessions/' + \
+        self.endpoint = API_URL + '/api/session/clients/user/v1/sessions/' + \
             session_UUID + '/validate'
         self.payload = json.dumps({
             "identifier": session_UUID,
@@ -294,7 +463,7 @@ class Request_2_3(ComdirectRequest):
 class Request_Challenge_Status(ComdirectRequest):
     def __init__(self, access_token, session_id, request_id, challenge_status_endpoint):
         self.method = 'GET'
-        self.endpoint = 'https://api.comdirect.de' + challenge_status_endpoint
+        self.endpoint = API_URL + challenge_status_endpoint
         self.payload = {}
         self.headers = {
             'Accept': 'application/json',
@@ -315,7 +484,7 @@ class Request_Challenge_Status(ComdirectRequest):
 class Request_2_4(ComdirectRequest):
     def __init__(self, access_token, session_id, request_id, session_UUID, challenge_id):
         self.method = 'PATCH'
-        self.endpoint = 'https://api.comdirect.de/api/session/clients/user/v1/sessions/' + session_UUID
+        self.endpoint = API_URL + '/api/session/clients/user/v1/sessions/' + session_UUID
         self.payload = json.dumps({
             "identifier": session_UUID,
             "sessionTanActive": True,
@@ -347,7 +516,7 @@ class Request_2_4(ComdirectRequest):
 class Request_2_5(ComdirectRequest):
     def __init__(self, client_id, client_secret, access_token):
         self.method = 'POST'
-        self.endpoint = "https://api.comdirect.de/oauth/token"
+        self.endpoint = API_URL + "/oauth/token"
         self.payload = 'client_id=' + client_id + '&client_secret=' + \
             client_secret + '&grant_type=cd_secondary&token=' + access_token
         self.headers = {
@@ -366,7 +535,7 @@ class Request_2_5(ComdirectRequest):
 class Request_3_1_1(ComdirectRequest):
     def __init__(self, client_id, client_secret, refresh_token):
         self.method = 'POST'
-        self.endpoint = "https://api.comdirect.de/oauth/token"
+        self.endpoint = API_URL + "/oauth/token"
         self.payload = 'client_id=' + client_id + '&client_secret=' + \
             client_secret + '&grant_type=refresh_token&refresh_token=' + refresh_token
         self.headers = {
@@ -385,7 +554,7 @@ class Request_3_1_1(ComdirectRequest):
 class Request_4_1_1(ComdirectRequest):
     def __init__(self, access_token, session_id, request_id):
         self.method = 'GET'
-        self.endpoint = "https://api.comdirect.de/api/banking/clients/user/v2/accounts/balances"
+        self.endpoint = API_URL + "/api/banking/clients/user/v2/accounts/balances"
         self.payload = {}
         self.headers = {
             'Accept': 'application/json',
@@ -401,22 +570,25 @@ class Request_4_1_1(ComdirectRequest):
 
         json = response.json()
 
-        # TODO: Normally the first account should be fine but there is
-        # still room for imprevement here. Maybe we could get all accounts
-        # here and request transactions for all of them.
-        comdirect.account_UUID = json['values'][0]['accountId']
+        comdirect.account_UUIDs = [value['accountId'] for value in json['values']]
+        comdirect.account_UUID = comdirect.account_UUIDs[0]
 
         return super().process_response(comdirect, response)
 
 # We limit this request to booked requests only because the paging-first parameter does only work with BOOKED transactions
+# paging-first is the index of the first transaction of the page, not the index of the page
 
 
 class Request_4_1_3(ComdirectRequest):
-    def __init__(self, access_token, session_id, request_id, account_UUID, paging_first):
+    def __init__(self, access_token, session_id, request_id, account_UUID, paging_first, min_booking_date=None, max_booking_date=None):
         self.method = 'GET'
-        self.endpoint = "https://api.comdirect.de/api/banking/v1/accounts/" + \
+        self.endpoint = API_URL + "/api/banking/v1/accounts/" + \
             account_UUID + "/transactions?paging-first=" + \
             str(paging_first) + "&transactionState=BOOKED"
+        if min_booking_date:
+            self.endpoint += "&min-bookingDate=" + min_booking_date.strftime('%Y-%m-%d')
+        if max_booking_date:
+            self.endpoint += "&max-bookingDate=" + max_booking_date.strftime('%Y-%m-%d')
         self.payload = {}
         self.headers = {
             'Accept': 'application/json',
@@ -435,7 +607,7 @@ class Request_4_1_3(ComdirectRequest):
 class Request_9_1_1(ComdirectRequest):
     def __init__(self, access_token, session_id, request_id, paging_first):
         self.method = 'GET'
-        self.endpoint = "https://api.comdirect.de/api/messages/clients/user/v2/documents?paging-first=" + \
+        self.endpoint = API_URL + "/api/messages/clients/user/v2/documents?paging-first=" + \
             str(paging_first)
         self.payload = {}
         self.headers = {
@@ -455,9 +627,9 @@ class Request_9_1_1(ComdirectRequest):
 
 
 class Request_9_1_2(ComdirectRequest):
-    def __init__(self, access_token, session_id, request_id, document_UUID, mimetype):
+    def __init__(self, access_token, session_id, request_id, document_UUID, mimetype, stream=False):
         self.method = 'GET'
-        self.endpoint = "https://api.comdirect.de/api/messages/v2/documents/" + document_UUID
+        self.endpoint = API_URL + "/api/messages/v2/documents/" + document_UUID
         self.payload = {}
         self.headers = {
             'Accept': mimetype,
@@ -465,6 +637,10 @@ class Request_9_1_2(ComdirectRequest):
             'x-http-request-info': '{"clientRequestId":{"sessionId":"' + session_id + '","requestId":"' + request_id + '"}}',
             'Content-Type': 'application/json'
         }
+        self.stream = stream
+        if stream:
+            # The Content-Length of the response must match the bytes read
+            self.headers['Accept-Encoding'] = 'identity'
         self.accepted_response_codes = {
             200
         }
@@ -1,25 +1,69 @@
 from babel import numbers
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from datetime import timedelta
 from logging.config import fileConfig
 from typing import Dict, Type
+import asynccomdirect
+import asyncio
+import batching
+import cache
 import comdirect
 import io
 import json
 import logging
+import matching
 import mayan
+import metrics
 import os
-import pdfkit
-import pickle
+import postbox
+import ratelimit
 import redis
-import redis_lock
+import rq
 
 
 # read initial config file - make sure we don't squash any loggers
 # not specifically declared in the config file.
-fileConfig("/app/config/logging.ini", disable_existing_loggers=False)
+config_dir = os.getenv("CONFIG_DIR", "/app/config")
+fileConfig(os.path.join(config_dir, "logging.ini"), disable_existing_loggers=False)
 _logger = logging.getLogger(__name__)
 
 redis_conn = redis.from_url(os.getenv("REDIS_CACHE_URL", "redis://localhost"))
+transaction_cache = cache.TransactionCache(
+    redis_conn, int(os.getenv("TRANSACTION_CACHE_TTL", 24 * 60 * 60))
+)
+# Cached transactions younger than this are used without asking comdirect for newer ones
+transaction_cache_max_age = int(os.getenv("TRANSACTION_CACHE_MAX_AGE", 60))
+# Upper bound of the difference between the valuta date and the booking date
+booking_delay = timedelta(days=14)
+comdirect_state = cache.ComdirectStateCache(redis_conn)
+# Retrieve transaction pages concurrently with the asyncio based client
+comdirect_async = os.getenv("COMDIRECT_ASYNC", "false") == "true"
+# API terms of use allow a maxmimum of 10 requests per second for all workers
+comdirect_rate_limiter = ratelimit.RateLimiter(
+    redis_conn, "comdirect", float(os.getenv("COMDIRECT_RATE_LIMIT", 10))
+)
+postbox_convert_workers = int(os.getenv("POSTBOX_CONVERT_WORKERS", 2))
+postbox_upload_workers = int(os.getenv("POSTBOX_UPLOAD_WORKERS", 4))
+# Maximum number of downloaded documents waiting for conversion or upload
+postbox_queue_size = int(os.getenv("POSTBOX_QUEUE_SIZE", 8))
+postbox_index = cache.PostboxIndex(redis_conn)
+reconciliation_state = cache.ReconciliationState(redis_conn)
+# Pipe PDF downloads into the mayan upload in chunks of this many bytes
+postbox_stream = os.getenv("POSTBOX_STREAM", "true") == "true"
+postbox_chunk_size = int(os.getenv("POSTBOX_CHUNK_SIZE", 64 * 1024))
+html_converter = postbox.HtmlConverter(int(os.getenv("POSTBOX_CONVERT_TIMEOUT", 60)))
+catalog_cache = cache.CatalogCache(
+    redis_conn, int(os.getenv("MAYAN_CATALOG_TTL", 60 * 60))
+)
+token_cache = cache.TokenCache(redis_conn)
+# Documents collected by the web service are kept in the queue redis
+queue_redis_conn = redis.from_url(os.getenv("REDIS_URL", "redis://localhost"))
+pending_transactions = batching.PendingTransactions(queue_redis_conn)
+# Documents of a failed matching run are matched again after this many
+# seconds until they failed this many times
+transaction_retry_delay = int(os.getenv("TRANSACTION_RETRY_DELAY", 60))
+transaction_retries = int(os.getenv("TRANSACTION_RETRIES", 3))
 
 
 def get_mayan_options():
@@ -28,6 +72,15 @@ def get_mayan_options():
     options["username"] = os.getenv("MAYAN_USER")
     options["password"] = os.getenv("MAYAN_PASSWORD")
     options["url"] = os.getenv("MAYAN_URL")
+    options["page_workers"] = int(os.getenv("MAYAN_PAGE_WORKERS", 4))
+    options["write_workers"] = int(os.getenv("MAYAN_WRITE_WORKERS", 4))
+    options["pool_size"] = int(os.getenv("MAYAN_POOL_SIZE", 10))
+    options["keepalive"] = int(os.getenv("MAYAN_KEEPALIVE", 60)) or None
+    options["verify"] = os.getenv("MAYAN_VERIFY", "true")
+    if options["verify"] in ("true", "false"):
+        options["verify"] = options["verify"] == "true"
+    options["retries"] = int(os.getenv("MAYAN_RETRIES", 3))
+    options["retry_backoff"] = float(os.getenv("MAYAN_RETRY_BACKOFF", 0.5))
     options["oidc_url"] = os.getenv("OIDC_URL")
     if options["oidc_url"]:
         options["oidc_user"] = os.getenv("OIDC_USER")
@@ -70,7 +123,7 @@ def get_comdirect_options():
 def get_config():
     config = json.load(
         open(
-            "/app/config/config.json",
+            os.path.join(config_dir, "config.json"),
         )
     )
     return config
@@ -78,7 +131,18 @@ def get_config():
 
 def get_mayan(args):
     _logger.info("logging into mayan")
-    m = mayan.Mayan(args["url"])
+    m = mayan.Mayan(
+        args["url"],
+        catalog_cache=catalog_cache,
+        token_cache=token_cache,
+        page_workers=args["page_workers"],
+        write_workers=args["write_workers"],
+        pool_size=args["pool_size"],
+        keepalive=args["keepalive"],
+        verify=args["verify"],
+        retries=args["retries"],
+        backoff=args["retry_backoff"],
+    )
     if args["oidc_url"]:
         m.oidcLogin(
             args["oidc_url"],
@@ -90,26 +154,115 @@ def get_mayan(args):
         )
     else:
         m.login(args["username"], args["password"])
-    _logger.info("load meta informations")
-    m.load()
+    # Meta informations are loaded on first use and shared between jobs
     return m
 
 
+@metrics.job
+def invalidate_mayan_catalog():
+    catalog_cache.invalidate()
+
+
 def get_comdirect(args):
-    cache = redis_conn.get("comdirect_cache")
-    if cache == None:
-        c = comdirect.Comdirect(
-            args["client_id"], args["client_secret"], args["zugangsnummer"], args["pin"]
-        )
-    else:
-        c = pickle.loads(cache)
+    c = comdirect.Comdirect(
+        args["client_id"], args["client_secret"], args["zugangsnummer"], args["pin"]
+    )
+    comdirect_state.load(c)
+    c.rate_limiter = comdirect_rate_limiter
+    c.state_store = comdirect_state
     return c
 
 
-def transaction(document, interactive):
-    args = get_mayan_options()
-    config = get_config()
-    m = get_mayan(args)
+def fetch_transactions(c, earliest, interactive, newer_than=None, latest=None):
+    if not comdirect_async:
+        return c.get_transactions(
+            earliest, interactive, newer_than=newer_than, latest=latest
+        )
+
+    async def fetch():
+        async with asynccomdirect.AsyncComdirect(
+            c.client_id, c.client_secret, c.zugangsnummer, c.pin
+        ) as ac:
+            ac.set_state(c.get_state())
+            ac.rate_limiter = c.rate_limiter
+            ac.state_store = c.state_store
+            transactions = await ac.get_transactions(
+                earliest, interactive, newer_than=newer_than, latest=latest
+            )
+            c.set_state(ac.get_state())
+            return transactions
+
+    return asyncio.run(fetch())
+
+
+def get_accounts(c):
+    # The accounts are only known to the session once comdirect has been
+    # asked for the balances. Until then, e.g. after the session expired,
+    # the accounts of the last synchronization are used.
+    account_UUIDs = getattr(c, "account_UUIDs", None)
+    if not account_UUIDs:
+        return transaction_cache.get_accounts()
+    return ",".join(sorted(account_UUIDs))
+
+
+def get_transactions(c, earliest, interactive):
+    # The cache holds the transactions of all accounts, each of them tagged
+    # with its accountId. It is keyed by the set of accounts so that a new
+    # or closed account causes a full synchronization.
+    # Returns the transactions and the time they are up to date as of, which
+    # is None if neither comdirect nor the cache could provide them.
+    accounts = get_accounts(c)
+    cached = transaction_cache.get(accounts)
+    covered = cached is not None and cached.covers(earliest)
+
+    if covered and cached.is_fresh(transaction_cache_max_age):
+        _logger.debug("Using cached transactions without synchronization")
+        return cache.filter_transactions(cached.transactions, earliest), cached.fetched
+
+    if not c.login(interactive):
+        if covered:
+            _logger.info("Not logged in. Using cached transactions only.")
+            return cache.filter_transactions(cached.transactions, earliest), cached.fetched
+        _logger.info("Not logged in. No cached transactions available.")
+        return [], None
+
+    synchronized = datetime.now()
+    if cached is None:
+        _logger.debug("Retrieving transactions since %s", earliest)
+        transactions = fetch_transactions(c, earliest, interactive)
+        window = earliest
+    else:
+        # Only the transactions booked since the newest cached transaction
+        # and those before the cached window are missing
+        _logger.debug("Retrieving transactions booked since %s", cached.latest)
+        transactions = fetch_transactions(
+            c, cached.earliest, interactive, newer_than=cached.latest or cached.earliest
+        )
+        transactions = cache.merge_transactions(transactions, cached.transactions)
+        window = cached.earliest
+        if not covered:
+            # The cache is filtered by valuta date so transactions that were
+            # booked a few days after the start of the cached window may
+            # still be missing
+            _logger.debug(
+                "Retrieving transactions between %s and %s", earliest, cached.earliest
+            )
+            older = fetch_transactions(
+                c, earliest, interactive, latest=cached.earliest + booking_delay
+            )
+            transactions = cache.merge_transactions(transactions, older)
+            window = earliest
+        if get_accounts(c) != accounts:
+            # The cache was keyed by the accounts of an earlier session
+            _logger.info("Accounts changed. Retrieving all transactions again.")
+            transactions = fetch_transactions(c, earliest, interactive)
+            window = earliest
+
+    transaction_cache.set(get_accounts(c), window, transactions)
+    return cache.filter_transactions(transactions, earliest), synchronized
+
+
+def load_document(m, document):
     _logger.info("load document %s", document)
 
     if isinstance(document, str):
@@ -117,31 +270,42 @@ def transaction(document, interactive):
             document = m.get(m.ep(f"documents/{document}"))
         else:
             _logger.error("document value %s must be numeric", document)
-            return
+            return None
 
     if not isinstance(document, dict):
         _logger.error("could not retrieve document")
-        return
+        return None
+
+    return document
 
+
+def get_document_metadata(m, document):
     doc_metadata = {
         x["metadata_type"]["name"]: x
         for x in m.all(m.ep("metadata", base=document["url"]))
     }
 
     _logger.debug("Retrieved metadata types: %s", doc_metadata.keys())
+    return doc_metadata
+
 
+def get_search_criteria(config, doc_metadata):
     search_criteria = {}
-    unsigned = True
     try:
         matchingconfig = config["transaction"]["matching"]
         amount = doc_metadata[matchingconfig["invoice_amount"]["metadatatype"]]["value"]
-        unsigned = matchingconfig["invoice_amount"]["unsigned"]
+        search_criteria["unsigned"] = matchingconfig["invoice_amount"]["unsigned"]
         amountlocale = matchingconfig["invoice_amount"]["locale"]
         amount_filtered = "".join(
             str(c) for c in (list(filter(lambda x: x in "-0123456789.,", amount)))
         )
         amount_decimal = numbers.parse_decimal(amount_filtered, locale=amountlocale)
         search_criteria["invoice_amount"] = amount_decimal
+        search_criteria["tolerance"] = matching.tolerance_cents(
+            matching.to_cents(amount_decimal),
+            matchingconfig["invoice_amount"].get("tolerance", 0),
+            matchingconfig["invoice_amount"].get("tolerance_percent", 0),
+        )
 
         search_criteria["invoice_number"] = doc_metadata[
             matchingconfig["invoice_number"]["metadatatype"]
@@ -150,86 +314,69 @@ def transaction(document, interactive):
         date = doc_metadata[matchingconfig["invoice_date"]["metadatatype"]]["value"]
         format = matchingconfig["invoice_date"]["dateformat"]
         search_criteria["invoice_date"] = datetime.strptime(date, format)
+        # Window of the transaction date relative to the invoice date
+        days_before = matchingconfig["invoice_date"].get("days_before", 0)
+        days_after = matchingconfig["invoice_date"].get("days_after")
+        search_criteria["earliest"] = search_criteria["invoice_date"] - timedelta(
+            days=days_before
+        )
+        search_criteria["latest"] = None
+        if days_after is not None:
+            search_criteria["latest"] = search_criteria["invoice_date"] + timedelta(
+                days=days_after
+            )
     except:
         _logger.error("Matching configuration is incomplete or incorrect.")
         raise
 
     _logger.debug("Document metadata found: " + str(search_criteria))
+    return search_criteria
 
-    # TODO: Cache transactions from the following call in redis and check if there are cached transactions available
-    # before querying from comdirect. For simplicity we should only cache the results of the last request. Therefore
-    # we always have to query comdirect again if the requested transaction was not found in the cache.
 
-    with redis_lock.Lock(redis_conn, name="api_lock", expire=15, auto_renewal=True):
-        c = get_comdirect(get_comdirect_options())
-        transactions = c.get_transactions(search_criteria["invoice_date"], interactive)
-        cache_api_state(c)
+def apply_transaction(m, config, document, doc_metadata, tx, detach=()):
+    # Metadata and tags are written concurrently once all writes are known.
+    # The tags in detach are removed from the document.
+    batch = m.batch()
+    if tx is not None:
+        _logger.info("Found transaction for document " + str(document))
+        metadata = {}
+        # TODO: Add possibility to configure mappings on deeper levels
+        # and basic transformations e.g. for date formats
+        mappingconfig = config["transaction"]["mapping"]
+        for property in mappingconfig.keys():
+            try:
+                propertyValue = tx[property]
+                metadata[mappingconfig[property]] = propertyValue
+            except:
+                _logger.error("Property " + property + " not found in transaction.")
 
-    transaction_found = False
-    for tx in transactions:
-        try:
-            tx_amount = tx["amount"]["value"]
-            tx_remittanceInfo = tx["remittanceInfo"]
-
-            if unsigned:
-                tx_amount = tx_amount.replace("-", "")
-
-            tx_amount_decimal = numbers.parse_decimal(tx_amount, locale="en_US")
-
-            if (
-                tx_amount_decimal == search_criteria["invoice_amount"]
-                and search_criteria["invoice_number"] in tx_remittanceInfo
-            ):
-                transaction_found = True
-                _logger.info("Found transaction for document " + str(document))
-                metadata = {}
-                # TODO: Add possibility to configure mappings on deeper levels
-                # and basic transformations e.g. for date formats
-                mappingconfig = config["transaction"]["mapping"]
-                for property in mappingconfig.keys():
-                    try:
-                        propertyValue = tx[property]
-                        metadata[mappingconfig[property]] = propertyValue
-                    except:
-                        _logger.error(
-                            "Property " + property + " not found in transaction."
-                        )
-
-                for meta in m.document_types[document["document_type"]["label"]][
-                    "metadatas"
-                ]:
-                    meta_name = meta["metadata_type"]["name"]
-                    if meta_name in metadata:
-                        if meta_name not in doc_metadata:
-                            _logger.info(
-                                "Add metadata %s (value: %s) to %s",
-                                meta_name,
-                                metadata[meta_name],
-                                document["url"],
-                            )
-                            data = {
-                                "metadata_type_id": meta["metadata_type"]["id"],
-                                "value": metadata[meta_name],
-                            }
-                            result = m.post(
-                                m.ep("metadata", base=document["url"]), json_data=data
-                            )
-                        else:
-                            data = {"value": metadata[meta_name]}
-                            result = m.put(
-                                m.ep(
-                                    "metadata/{}".format(doc_metadata[meta_name]["id"]),
-                                    base=document["url"],
-                                ),
-                                json_data=data,
-                            )
-                break
-        except:
-            _logger.debug("No amount or remittanceInfo found. Skipping transaction.")
-            raise
+        for meta in m.document_type_metadatas(document["document_type"]["label"]):
+            meta_name = meta["metadata_type"]["name"]
+            if meta_name in metadata:
+                if meta_name not in doc_metadata:
+                    _logger.info(
+                        "Add metadata %s (value: %s) to %s",
+                        meta_name,
+                        metadata[meta_name],
+                        document["url"],
+                    )
+                    data = {
+                        "metadata_type_id": meta["metadata_type"]["id"],
+                        "value": metadata[meta_name],
+                    }
+                    batch.post(m.ep("metadata", base=document["url"]), json_data=data)
+                else:
+                    data = {"value": metadata[meta_name]}
+                    batch.put(
+                        m.ep(
+                            "metadata/{}".format(doc_metadata[meta_name]["id"]),
+                            base=document["url"],
+                        ),
+                        json_data=data,
+                    )
 
     taggingconfig = config["transaction"]["tagging"]
-    if transaction_found:
+    if tx is not None:
         attach = taggingconfig["success"]
     else:
         attach = taggingconfig["failure"]
@@ -245,111 +392,384 @@ def transaction(document, interactive):
             + str(data["tag"])
             + " to document"
         )
-        result = m.post(m.ep("tags/attach", base=document["url"]), json_data=data)
+        batch.post(m.ep("tags/attach", base=document["url"]), json_data=data)
+    for t in detach:
+        if t in m.tags:
+            data = {"tag": m.tags[t]["id"]}
+            batch.post(m.ep("tags/remove", base=document["url"]), json_data=data)
+    send_batch(batch, document["url"])
+
+
+def send_batch(batch, url):
+    count = len(batch)
+    errors = batch.send()
+    for endpoint, error in errors:
+        _logger.error("Failed to write %s: %s", endpoint, error)
+    if errors:
+        raise Exception(
+            "Failed %d of %d writes to document %s" % (len(errors), count, url)
+        )
 
 
-def keepalive():
-    with redis_lock.Lock(redis_conn, name="api_lock", expire=15, auto_renewal=True):
-        c = get_comdirect(get_comdirect_options())
-        c.login(False)
-        cache_api_state(c)
+def raise_failed(failed):
+    if failed:
+        raise Exception("Failed to match documents %s" % ", ".join(failed))
 
 
-def import_postbox(interactive, get_ads, get_archived, get_read):
+@metrics.job
+def transaction(document, interactive):
+    raise_failed(match_documents([document], interactive))
+
+
+@metrics.job
+def transactions_batch(documents, interactive):
+    raise_failed(match_documents(documents, interactive))
+
+
+@metrics.job
+def match_pending():
+    # Matches all documents triggered since the last run at once
+    documents, interactive = pending_transactions.take()
+    if not documents:
+        return
+    try:
+        failed = match_documents(documents, interactive)
+    except Exception:
+        retry_pending(documents, interactive)
+        raise
+    pending_transactions.done([d for d in documents if d not in failed])
+    if failed:
+        retry_pending(failed, interactive)
+        raise_failed(failed)
+
+
+def retry_pending(documents, interactive):
+    # The documents are no longer pending and have to be added again
+    retried, schedule = pending_transactions.retry(
+        documents, interactive, transaction_retries
+    )
+    if retried:
+        _logger.info("Matching documents %s again later", ", ".join(retried))
+    if schedule:
+        queue = rq.Queue("comdirect", connection=queue_redis_conn)
+        queue.enqueue_in(timedelta(seconds=transaction_retry_delay), match_pending)
+
+
+def match_documents(documents, interactive):
+    # Returns the IDs of the documents that could not be matched or updated.
+    # Errors that affect all documents are raised.
     args = get_mayan_options()
     config = get_config()
     m = get_mayan(args)
-    _logger.info("importing postbox")
 
-    # TODO: The locking should all be centralized in get_comdirect
-    with redis_lock.Lock(redis_conn, name="api_lock", expire=15, auto_renewal=True):
-        c = get_comdirect(get_comdirect_options())
-        documents = c.get_postbox_documents(
-            interactive, get_ads, get_archived, get_read
+    # Collect the search criteria of all documents first so that a single
+    # transaction retrieval covering the earliest search window is sufficient
+    pending = []
+    failed = []
+    for document_id in documents:
+        try:
+            document = load_document(m, document_id)
+            if document is None:
+                continue
+            doc_metadata = get_document_metadata(m, document)
+            search_criteria = get_search_criteria(config, doc_metadata)
+            pending.append((document, doc_metadata, search_criteria))
+        except Exception:
+            _logger.exception("Skipping document %s", document_id)
+            failed.append(str(document_id))
+
+    if len(pending) == 0:
+        return failed  # No documents to process
+
+    earliest = min(criteria["earliest"] for _, _, criteria in pending)
+    results, _ = find_transactions(config, pending, earliest, interactive)
+    for key, (document, doc_metadata, _) in enumerate(pending):
+        # A failing document must not keep the others from being updated
+        try:
+            apply_transaction(m, config, document, doc_metadata, results[key])
+        except Exception:
+            _logger.exception("Failed to update document %s", document["id"])
+            failed.append(str(document["id"]))
+    return failed
+
+
+def find_transactions(config, pending, earliest, interactive):
+    # Matches (document, doc_metadata, search_criteria) tuples against the
+    # transactions since earliest. Returns the transaction or None by index
+    # and the time the transactions are up to date as of (see get_transactions).
+    _logger.info(
+        "Matching %d documents against transactions since %s", len(pending), earliest
+    )
+
+    c = get_comdirect(get_comdirect_options())
+    known_accounts = getattr(c, "account_UUIDs", None)
+    transactions, synchronized = get_transactions(c, earliest, interactive)
+    if getattr(c, "account_UUIDs", None) != known_accounts:
+        comdirect_state.update(c, "account_UUID", "account_UUIDs")
+
+    index = matching.TransactionIndex(
+        transactions,
+        config["transaction"]["matching"]["invoice_number"].get("normalize", False),
+    )
+    searches = [
+        matching.Search(
+            key,
+            matching.to_cents(search_criteria["invoice_amount"]),
+            search_criteria["invoice_number"],
+            search_criteria["earliest"].strftime("%Y-%m-%d"),
+            search_criteria["unsigned"],
+            search_criteria["tolerance"],
+            search_criteria["latest"] and search_criteria["latest"].strftime("%Y-%m-%d"),
         )
-        cache_api_state(c)
+        for key, (_, _, search_criteria) in enumerate(pending)
+    ]
+    return index.match_many(searches), synchronized
 
-    _logger.debug("Received %d documents", len(documents))
-    if len(documents) == 0:
-        return  # No documents to process
-    
-    postboxconfig = config["postbox"]
-    document_type_id = m.document_types[postboxconfig["documenttype"]]["id"]
 
-    for document in documents:
-        create_data = {
-            "document_type_id": document_type_id,
-            "label": document["name"],
-            "language": "deu",
-        }
-        result_create = m.post(m.ep("documents"), json_data=create_data)
-
-        if document["mimeType"] == "application/pdf":
-            _logger.debug("Document is a pdf file")
-            with io.BytesIO(document["content"]) as documentfile:
-                resultUpload = m.uploadfile(
-                    m.ep(
-                        "files",
-                        base=result_create["url"],
-                    ),
-                    json_data={"action_name": "replace"},
-                    file_data={"file_new": documentfile},
-                )
+@metrics.job
+def reconcile(interactive):
+    # Matches all documents still tagged as unpaid against the transactions
+    # booked since the last run
+    args = get_mayan_options()
+    config = get_config()
+    m = get_mayan(args)
 
-        if document["mimeType"] == "text/html":
-            _logger.debug("Document is a html file")
-            with io.StringIO(document["content"]) as documentfile:
-                _logger.debug("Trying to convert to pdf")
-                # from_file now complains about a missing output_path. trying with the code from the pdfkit tests
-                # pdf = pdfkit.from_file(documentfile)
-                r = pdfkit.PDFKit(documentfile, "file")
-                pdf = r.to_pdf()
-
-            with io.BytesIO(pdf) as pdffile:
-                resultUpload = m.uploadfile(
-                    m.ep(
-                        "files",
-                        base=result_create["url"],
-                    ),
-                    json_data={"action_name": "replace"},
-                    file_data={"file_new": pdffile},
-                )
+    failure = config["transaction"]["tagging"]["failure"]
+    documents = {}
+    for t in failure:
+        if t not in m.tags:
+            _logger.info("Tag %s not defined in system", t)
+            continue
+        for document in m.all(m.ep("documents", base=m.tags[t]["url"])):
+            documents[document["id"]] = document
+    if not documents:
+        _logger.info("No documents to reconcile")
+        return
 
-        metadata = {}
-        # TODO: Add possibility to configure mappings on deeper levels
-        # and basic transformations e.g. for date formats
-        mappingconfig = config["postbox"]["mapping"]
-        for property in mappingconfig.keys():
-            try:
-                propertyValue = document[property]
-                metadata[mappingconfig[property]] = propertyValue
-            except:
-                _logger.error("Property " + property + " not found in document.")
+    documents = list(documents.values())
+    with ThreadPoolExecutor(max_workers=m.page_workers) as executor:
+        metadata = list(
+            executor.map(lambda document: get_document_metadata(m, document), documents)
+        )
+    pending = []
+    for document, doc_metadata in zip(documents, metadata):
+        try:
+            search_criteria = get_search_criteria(config, doc_metadata)
+        except Exception:
+            _logger.warning("Skipping document %s", document["id"])
+            continue
+        pending.append((document, doc_metadata, search_criteria))
+    if not pending:
+        return
 
-        for meta in m.document_types[result_create["document_type"]["label"]][
-            "metadatas"
-        ]:
-            meta_name = meta["metadata_type"]["name"]
-            if meta_name in metadata:
-                _logger.info(
-                    "Add metadata %s (value: %s) to %s",
-                    meta_name,
-                    metadata[meta_name],
-                    result_create["url"],
+    earliest = min(criteria["earliest"] for _, _, criteria in pending)
+    last_run = reconciliation_state.get()
+    if last_run is not None:
+        # Transactions booked before the last run have been matched already.
+        # Their value date may precede the booking date.
+        earliest = max(earliest, last_run - booking_delay)
+    results, synchronized = find_transactions(config, pending, earliest, interactive)
+    if synchronized is None:
+        # Transactions booked in the meantime are matched by the next run
+        _logger.warning("No transactions available. Reconciliation skipped.")
+        return
+
+    matched = 0
+    failed = 0
+    for key, (document, doc_metadata, _) in enumerate(pending):
+        if results[key] is None:
+            continue
+        try:
+            apply_transaction(
+                m, config, document, doc_metadata, results[key], detach=failure
+            )
+            matched += 1
+        except Exception:
+            _logger.exception("Failed to reconcile document %s", document["id"])
+            failed += 1
+    _logger.info("Reconciled %d of %d documents", matched, len(pending))
+    if failed:
+        # The next run has to see the transactions of the failed documents again
+        raise Exception("Failed to reconcile %d documents" % failed)
+    reconciliation_state.set(synchronized)
+
+
+@metrics.job
+def keepalive():
+    c = get_comdirect(get_comdirect_options())
+    c.login(False)
+
+
+@metrics.job
+def import_postbox(interactive, get_ads, get_archived, get_read):
+    args = get_mayan_options()
+    config = get_config()
+    m = get_mayan(args)
+    _logger.info("importing postbox")
+    # Resolve the catalog before it is used by several upload threads
+    m.document_type_metadatas(config["postbox"]["documenttype"])
+
+    c = get_comdirect(get_comdirect_options())
+    pipeline = postbox.PostboxPipeline(
+        html_converter,
+        lambda document, pdf: import_document(m, config, document, pdf),
+        postbox_convert_workers,
+        postbox_upload_workers,
+        postbox_queue_size,
+    )
+    # Documents are converted and uploaded while the next ones are downloaded
+    with pipeline:
+        for document in c.iter_postbox_documents(
+            interactive,
+            get_ads,
+            get_archived,
+            get_read,
+            skip=is_imported,
+            stream=postbox_stream,
+            before_stream=pipeline.reserve_stream,
+        ):
+            if "response" in document:
+                stream = postbox.DownloadStream(
+                    document.pop("response"), postbox_chunk_size
                 )
-                data = {
-                    "metadata_type_id": meta["metadata_type"]["id"],
-                    "value": metadata[meta_name],
-                }
-                result = m.post(
-                    m.ep("metadata", base=result_create["url"]), json_data=data
+                if stream.length is not None:
+                    # The content hash is checked after the upload
+                    document["content"] = stream
+                    pipeline.submit(document)
+                    continue
+                # A multipart body without a known length can't be streamed
+                with stream:
+                    document["content"] = stream.response.content
+                pipeline.release_stream()
+            metrics.inc(
+                "comdirect_postbox_bytes",
+                postbox.content_size(document.get("content")),
+                direction="download",
+            )
+            digest = postbox.content_hash(document.get("content"))
+            mayan_id = postbox_index.find_hash(digest) if digest else None
+            if mayan_id is not None:
+                _logger.info(
+                    "Skipping %s. Same content was imported as document %d",
+                    document["name"],
+                    mayan_id,
                 )
+                postbox_index.add(document["documentId"], digest, mayan_id)
+                continue
+            document["contentHash"] = digest
+            pipeline.submit(document)
+
+    _logger.debug("Imported %d documents", pipeline.imported)
+    if pipeline.errors:
+        raise Exception(
+            "Failed to import %d of %d documents"
+            % (len(pipeline.errors), len(pipeline.errors) + pipeline.imported)
+        )
 
 
-def cache_api_state(comdirect):
-    # For simplicity we use pickle. For security reasons we should consider a JSON format.
-    # However the datetime types in comdirect prevent the simple JSONification.
-    pickled = pickle.dumps(comdirect)
-    # We need to log in again after 20 minutes anyway
-    # so we might as well clear the cache after 20 minutes
-    redis_conn.set("comdirect_cache", pickled, 1200)
+def is_imported(document):
+    if postbox_index.contains(document["documentId"]):
+        _logger.debug("Skipping %s. Already imported.", document["name"])
+        return True
+    return False
+
+
+def upload_document(m, document, pdf, url):
+    # Raises an error unless the complete content arrived in mayan
+    if isinstance(pdf, postbox.DownloadStream):
+        _logger.debug("Streaming %s (%s)", document["name"], document["mimeType"])
+        with pdf:
+            m.uploadstream(
+                m.ep("files", base=url),
+                json_data={"action_name": "replace"},
+                name="file_new",
+                filename="file_new",
+                fileobj=pdf,
+                length=pdf.length,
+                content_type=document["mimeType"],
+            )
+        if pdf.bytes_read != pdf.length:
+            raise Exception(
+                "Streamed %d of %d bytes of %s"
+                % (pdf.bytes_read, pdf.length, document["name"])
+            )
+        for direction in ("download", "upload"):
+            metrics.inc("comdirect_postbox_bytes", pdf.bytes_read, direction=direction)
+        document["contentHash"] = pdf.hexdigest()
+        # The content of a streamed document is only known after the upload
+        document["duplicateOf"] = postbox_index.find_hash(document["contentHash"])
+    elif pdf is not None:
+        _logger.debug("Uploading %s (%s)", document["name"], document["mimeType"])
+        metrics.inc("comdirect_postbox_bytes", len(pdf), direction="upload")
+        with io.BytesIO(pdf) as pdffile:
+            m.uploadfile(
+                m.ep("files", base=url),
+                json_data={"action_name": "replace"},
+                file_data={"file_new": pdffile},
+            )
+
+
+def import_document(m, config, document, pdf):
+    postboxconfig = config["postbox"]
+    document_type_id = m.document_types[postboxconfig["documenttype"]]["id"]
+
+    create_data = {
+        "document_type_id": document_type_id,
+        "label": document["name"],
+        "language": "deu",
+    }
+    result_create = m.post(m.ep("documents"), json_data=create_data)
+    try:
+        upload_document(m, document, pdf, result_create["url"])
+    except Exception:
+        # The document is imported again by the next run
+        m.delete(result_create["url"])
+        raise
+    if document.get("duplicateOf") is not None:
+        _logger.info(
+            "Deleting %s again. Same content was imported as document %d",
+            document["name"],
+            document["duplicateOf"],
+        )
+        m.delete(result_create["url"])
+        postbox_index.add(
+            document["documentId"], document["contentHash"], document["duplicateOf"]
+        )
+        return
+
+    metadata = {}
+    # TODO: Add possibility to configure mappings on deeper levels
+    # and basic transformations e.g. for date formats
+    mappingconfig = config["postbox"]["mapping"]
+    for property in mappingconfig.keys():
+        try:
+            propertyValue = document[property]
+            metadata[mappingconfig[property]] = propertyValue
+        except:
+            _logger.error("Property " + property + " not found in document.")
+
+    batch = m.batch()
+    for meta in m.document_type_metadatas(result_create["document_type"]["label"]):
+        meta_name = meta["metadata_type"]["name"]
+        if meta_name in metadata:
+            _logger.info(
+                "Add metadata %s (value: %s) to %s",
+                meta_name,
+                metadata[meta_name],
+                result_create["url"],
+            )
+            data = {
+                "metadata_type_id": meta["metadata_type"]["id"],
+                "value": metadata[meta_name],
+            }
+            batch.post(m.ep("metadata", base=result_create["url"]), json_data=data)
+    try:
+        send_batch(batch, result_create["url"])
+    except Exception:
+        # Like a failed upload, so that the next run doesn't create a duplicate
+        m.delete(result_create["url"])
+        raise
+
+    postbox_index.add(
+        document["documentId"], document.get("contentHash"), result_create["id"]
+    )
@@ -2,7 +2,11 @@
 
 if [ "$1" == "rq" ]; then
     echo "rq mode"
-    rq worker comdirect -vvv --url $REDIS_URL
+    if [ "$COMDIRECT_KEEPALIVE" == "true" ]; then
+        echo "starting keepalive"
+        python keepalive.py &
+    fi
+    rq worker comdirect -vvv --with-scheduler --url $REDIS_URL
 fi
 
 if [ "$1" == "web" ]; then
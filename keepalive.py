@@ -0,0 +1,77 @@
+"""Keeps an active comdirect session alive by refreshing the tokens
+shortly before the refresh token expires.
+
+Runs next to the rq worker (see entrypoint.sh) so that refreshes never
+wait behind queued jobs.
+"""
+from comdirectworker import comdirect_state
+from comdirectworker import get_comdirect
+from comdirectworker import get_comdirect_options
+from comdirectworker import redis_conn
+from datetime import datetime
+import logging
+import os
+import time
+
+_logger = logging.getLogger(__name__)
+
+# Seconds before the expiry of the refresh token at which the tokens are refreshed
+lead = int(os.getenv("KEEPALIVE_LEAD", 60))
+# Maximum seconds between two looks at the cached session state
+poll_interval = int(os.getenv("KEEPALIVE_POLL_INTERVAL", 30))
+
+
+def seconds_until_refresh():
+    state = comdirect_state.get("refresh_token_expiry")
+    if "refresh_token_expiry" not in state:
+        return None
+    expiry = datetime.fromisoformat(state["refresh_token_expiry"])
+    if expiry <= datetime.now():
+        return None  # No active session
+    return (expiry - datetime.now()).total_seconds() - lead
+
+
+def refresh():
+    c = get_comdirect(get_comdirect_options())
+    margin = (c.refresh_token_expiry - datetime.now()).total_seconds()
+    if margin <= 0:
+        _logger.info("Session expired %.0f seconds ago", -margin)
+        return
+    if c.refresh_session(lead):
+        _logger.info("Refreshed session with %.1f seconds left", margin)
+        record(margin)
+
+
+def record(margin):
+    stats = redis_conn.hgetall("keepalive_stats")
+    min_margin = float(stats.get(b"min_margin", margin))
+    pipe = redis_conn.pipeline()
+    pipe.hincrby("keepalive_stats", "refreshes", 1)
+    pipe.hset(
+        "keepalive_stats",
+        mapping={
+            "last_refresh": datetime.now().isoformat(),
+            "last_margin": margin,
+            "min_margin": min(min_margin, margin),
+        },
+    )
+    pipe.execute()
+
+
+def run():
+    _logger.info("Starting keepalive with a lead of %d seconds", lead)
+    while True:
+        try:
+            wait = seconds_until_refresh()
+            if wait is not None and wait <= 0:
+                refresh()
+                continue
+            # Look again later since other workers may start or refresh a session
+            time.sleep(poll_interval if wait is None else min(wait, poll_interval))
+        except Exception:
+            _logger.exception("Keepalive failed")
+            time.sleep(poll_interval)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,231 @@
+from bisect import bisect_left
+from bisect import bisect_right
+from collections import deque
+from collections import namedtuple
+from decimal import Decimal
+from decimal import InvalidOperation
+import heapq
+import logging
+import re
+
+_logger = logging.getLogger(__name__)
+
+# A transaction reduced to the values required for matching.
+# position keeps the order of the transactions as returned by comdirect
+# so that the newest transaction wins if several transactions match.
+Entry = namedtuple('Entry', ['position', 'cents', 'date', 'text', 'tx'])
+
+# A document to be matched. earliest and latest are ISO date strings
+# (YYYY-MM-DD) or None. Transactions whose amount differs by up to
+# tolerance cents match as well, the closest amount is preferred.
+Search = namedtuple('Search', ['key', 'cents', 'invoice_number', 'earliest', 'unsigned',
+                               'tolerance', 'latest'], defaults=(0, None))
+
+
+def to_cents(amount):
+    # Amounts returned by comdirect always use a . as decimal separator
+    return int((Decimal(amount) * 100).to_integral_value())
+
+
+def tolerance_cents(cents, tolerance=0, tolerance_percent=0):
+    # The larger of an absolute tolerance and a share of the amount, e.g.
+    # to accept a payment reduced by a cash discount
+    relative = Decimal(abs(cents)) * Decimal(str(tolerance_percent)) / 100
+    return max(to_cents(str(tolerance)), int(relative.to_integral_value()))
+
+
+def normalize_text(text):
+    if not text:
+        return ''
+    return ' '.join(text.split()).casefold()
+
+
+# Sorts after every ISO date
+MAX_DATE = '9999-99-99'
+
+DASHES = re.compile(r'[\s\-\u2010-\u2015]+')
+LEADING_ZEROS = re.compile(r'(?<!\d)0+(?=\d)')
+
+
+def normalize_number(text):
+    # "RE - 000123" and "re123" are the same invoice number. Applied to the
+    # remittance information as well so that the number is still found in it.
+    if not text:
+        return ''
+    return LEADING_ZEROS.sub('', DASHES.sub('', text.casefold()))
+
+
+class KeywordMatcher:
+    """Aho-Corasick automaton that finds all keywords in a text in one pass."""
+
+    def __init__(self, keywords) -> None:
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [set()]
+        for keyword in keywords:
+            if keyword:
+                self.__add(keyword)
+        self.__build()
+
+    def __add(self, keyword):
+        state = 0
+        for char in keyword:
+            if char not in self.goto[state]:
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append(set())
+                self.goto[state][char] = len(self.goto) - 1
+            state = self.goto[state][char]
+        self.output[state].add(keyword)
+
+    def __build(self):
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fail = self.fail[state]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[next_state] = self.goto[fail].get(char, 0)
+                self.output[next_state] |= self.output[self.fail[next_state]]
+
+    def find(self, text):
+        found = set()
+        state = 0
+        for char in text:
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            if self.output[state]:
+                found |= self.output[state]
+        return found
+
+
+class TransactionIndex:
+    """Transactions normalized once and sorted by amount and date.
+
+    The transactions are kept sorted by amount and then date, so the
+    candidates of a search are found with range queries over both instead
+    of comparing every transaction. With normalize_numbers invoice numbers
+    are compared with normalize_number().
+    """
+
+    def __init__(self, transactions, normalize_numbers=False) -> None:
+        self.normalize = normalize_number if normalize_numbers else normalize_text
+        entries = []
+        for position, tx in enumerate(transactions):
+            entry = self.__normalize(position, tx)
+            if entry is not None:
+                entries.append(entry)
+        # Transactions without a date sort first as ''
+        entries.sort(key=lambda entry: (entry.cents, entry.date or ''))
+        self.entries = entries
+        self.keys = [(entry.cents, entry.date or '') for entry in entries]
+        self.size = len(entries)
+        _logger.debug('Indexed %d transactions', self.size)
+
+    def __normalize(self, position, tx):
+        try:
+            cents = to_cents(tx['amount']['value'])
+        except (KeyError, TypeError, InvalidOperation):
+            _logger.debug('No amount found. Skipping transaction.')
+            return None
+        # ISO dates compare correctly as strings which saves parsing them
+        date = tx.get('valutaDate') or None
+        return Entry(position, cents, date, self.normalize(tx.get('remittanceInfo')), tx)
+
+    def __dated(self, start, end, earliest, latest):
+        # The entries between start and end share their amount. Those
+        # without a date are never excluded.
+        keys = self.keys
+        cents = keys[start][0]
+        undated = bisect_right(keys, (cents, ''), start, end)
+        first = bisect_left(keys, (cents, earliest), undated, end) if earliest else undated
+        last = bisect_right(keys, (cents, latest or MAX_DATE), first, end)
+        return self.entries[start:undated] + self.entries[first:last]
+
+    def __groups(self, target, tolerance, earliest, latest):
+        # Yields (distance, entries) for every amount within the tolerance,
+        # walking outwards from the target so the closest amounts come first
+        keys = self.keys
+        right = bisect_left(keys, (target, ''))
+        left = right
+        while True:
+            above = keys[right][0] if right < len(keys) else None
+            below = keys[left - 1][0] if left > 0 else None
+            if above is not None and above - target > tolerance:
+                above = None
+            if below is not None and target - below > tolerance:
+                below = None
+            if above is None and below is None:
+                return
+            if below is None or (above is not None and above - target <= target - below):
+                end = bisect_right(keys, (above, MAX_DATE), right)
+                yield above - target, self.__dated(right, end, earliest, latest)
+                right = end
+            else:
+                start = bisect_left(keys, (below, ''), 0, left)
+                yield target - below, self.__dated(start, left, earliest, latest)
+                left = start
+
+    def candidates(self, cents, unsigned=False, earliest=None, tolerance=0, latest=None):
+        """Transactions that may belong to a search in the order of preference.
+
+        The closest amount comes first and the newest transaction among
+        those with the same distance. The candidates are produced lazily
+        so a search that matches an exact amount doesn't look any further.
+        """
+        targets = [cents]
+        if unsigned and cents != 0:
+            targets.append(-cents)
+        groups = heapq.merge(*(self.__groups(target, tolerance, earliest, latest)
+                               for target in targets), key=lambda group: group[0])
+        seen = set()
+        distance = None
+        pending = []
+        for group_distance, entries in groups:
+            if group_distance != distance:
+                yield from sorted(pending, key=lambda entry: entry.position)
+                distance = group_distance
+                pending = []
+            for entry in entries:
+                # The ranges of both signs overlap for small amounts
+                if entry.position not in seen:
+                    seen.add(entry.position)
+                    pending.append(entry)
+        yield from sorted(pending, key=lambda entry: entry.position)
+
+    def find(self, cents, invoice_number, earliest=None, unsigned=False, tolerance=0, latest=None):
+        invoice_number = self.normalize(invoice_number)
+        for entry in self.candidates(cents, unsigned, earliest, tolerance, latest):
+            if invoice_number in entry.text:
+                return entry.tx
+        return None
+
+    def match_many(self, searches):
+        """Match many searches at once.
+
+        Every candidate transaction is only scanned once for all invoice
+        numbers of the searches it is a candidate of. Returns a dict that
+        maps the key of each search to the matching transaction or None.
+        """
+        results = {search.key: None for search in searches}
+        numbers = {search.key: self.normalize(search.invoice_number)
+                   for search in searches}
+        matcher = KeywordMatcher(set(numbers.values()))
+
+        found = {}
+        for search in searches:
+            number = numbers[search.key]
+            for entry in self.candidates(search.cents, search.unsigned, search.earliest,
+                                         search.tolerance, search.latest):
+                # An empty invoice number is contained in every text
+                if number:
+                    if entry.position not in found:
+                        found[entry.position] = matcher.find(entry.text)
+                    if number not in found[entry.position]:
+                        continue
+                results[search.key] = entry.tx
+                break
+        return results
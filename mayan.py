@@ -1,12 +1,25 @@
+from concurrent.futures import ThreadPoolExecutor
 from json import JSONDecodeError
+from requests.adapters import HTTPAdapter
 from typing import Union
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+from urllib3.connection import HTTPConnection
+import io
 import json
 import logging
+import math
+import metrics
 import re
 import requests
+import secrets
+import socket
+import time
 
 _logger = logging.getLogger(__name__)
 
+# Status codes of an overloaded mayan or proxy that are worth a retry
+RETRY_STATUS = (429, 502, 503)
+
 
 class Endpoint(object):
     def __init__(self, endpoint: str, *, params: dict = {}, base: str = None):
@@ -55,20 +68,190 @@ class Endpoint(object):
     __str__ = __repr__
 
 
+class MultipartStream(object):
+    """multipart/form-data body whose file part is read from a stream.
+
+    The parts are produced while the body is sent so only the chunk being
+    sent is held in memory. fileobj has to deliver exactly length bytes,
+    which makes the Content-Length of the body known in advance.
+    """
+
+    def __init__(self, fields: dict, name, filename, fileobj, length, content_type):
+        self.boundary = secrets.token_hex(16)
+        head = b""
+        for field, value in fields.items():
+            head += (
+                f"--{self.boundary}\r\n"
+                f'Content-Disposition: form-data; name="{field}"\r\n\r\n'
+                f"{value}\r\n"
+            ).encode()
+        head += (
+            f"--{self.boundary}\r\n"
+            f'Content-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+            f"Content-Type: {content_type}\r\n\r\n"
+        ).encode()
+        tail = f"\r\n--{self.boundary}--\r\n".encode()
+        self.length = len(head) + length + len(tail)
+        self.content_type = "multipart/form-data; boundary=" + self.boundary
+        self._parts = [io.BytesIO(head), fileobj, io.BytesIO(tail)]
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size=-1):
+        while self._parts:
+            data = self._parts[0].read(size)
+            if data:
+                return data
+            self._parts.pop(0)
+        return b""
+
+    def __iter__(self):
+        return iter(lambda: self.read(8192), b"")
+
+
+class WriteBatch(object):
+    """Independent write requests that are sent concurrently.
+
+    The metadata and tag writes of a document don't depend on each other,
+    so they are collected and sent through a pool of workers sharing the
+    session of the mayan client. send() waits for all writes and returns
+    the errors of the failed ones instead of stopping at the first error.
+    """
+
+    def __init__(self, mayan, workers):
+        self.mayan = mayan
+        self.workers = workers
+        self._writes = []
+
+    def __len__(self):
+        return len(self._writes)
+
+    def post(self, endpoint: Union[str, Endpoint], json_data):
+        self._writes.append(("POST", endpoint, json_data))
+
+    def put(self, endpoint: Union[str, Endpoint], json_data):
+        self._writes.append(("PUT", endpoint, json_data))
+
+    def send(self):
+        # Returns a list of (endpoint, exception) for the failed writes,
+        # including those mayan answered with an error status
+        writes, self._writes = self._writes, []
+        if not writes:
+            return []
+
+        def write(request):
+            method, endpoint, json_data = request
+            if self.mayan.test:
+                print("WOULD", method, str(endpoint), json.dumps(json_data, indent=2))
+                return None
+            try:
+                result = self.mayan._send(method, endpoint, json=json_data)
+            except Exception as e:
+                return str(endpoint), e
+            if not 200 <= result.status_code < 300:
+                return str(endpoint), Exception(
+                    "Status %s: %s" % (result.status_code, result.text)
+                )
+
+        _logger.debug("Sending %d writes with %d workers", len(writes), self.workers)
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(writes))) as executor:
+            return [error for error in executor.map(write, writes) if error]
+
+
+class PoolAdapter(HTTPAdapter):
+    """HTTPAdapter that keeps idle pooled connections alive with TCP keepalive.
+
+    keepalive is the number of idle seconds after which the first probe is
+    sent, so that firewalls and proxies don't silently drop connections
+    waiting in the pool. None leaves the socket defaults untouched.
+    """
+
+    def __init__(self, pool_size=10, keepalive=None):
+        self.keepalive = keepalive
+        super().__init__(pool_connections=pool_size, pool_maxsize=pool_size)
+
+    def init_poolmanager(self, *args, **kwargs):
+        if self.keepalive:
+            options = [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+            if hasattr(socket, "TCP_KEEPIDLE"):
+                options += [
+                    (socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, self.keepalive),
+                    (socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, self.keepalive),
+                ]
+            kwargs["socket_options"] = HTTPConnection.default_socket_options + options
+        super().init_poolmanager(*args, **kwargs)
+
+
 class Mayan(object):
-    def __init__(self, baseurl, test=False):
+    def __init__(
+        self,
+        baseurl,
+        test=False,
+        catalog_cache=None,
+        token_cache=None,
+        page_workers=1,
+        write_workers=1,
+        pool_size=10,
+        keepalive=None,
+        verify=True,
+        retries=3,
+        backoff=0.5,
+    ):
         self.test = test
         self.baseurl = baseurl
-        pass
+        # Number of pages all() retrieves concurrently
+        self.page_workers = page_workers
+        # Number of requests of a batch() sent concurrently
+        self.write_workers = write_workers
+        # Connections kept open for the threads sharing the session. It
+        # should not be lower than the number of concurrent requests.
+        self.pool_size = pool_size
+        self.keepalive = keepalive
+        # Passed to requests for every request, may be a CA bundle path
+        self.verify = verify
+        # Requests answered with a RETRY_STATUS are sent again up to retries
+        # times after waiting backoff seconds, doubled for every attempt
+        self.retries = retries
+        self.backoff = backoff
+        # Optional shared cache with get(baseurl, name) and set(baseurl, name, value)
+        self.catalog_cache = catalog_cache
+        self._catalog = {}
+        # Optional shared cache with get(key), set(key, authorization, expires_in) and lock(key)
+        self.token_cache = token_cache
+        self._obtain_token = None
 
     def ep(self, endpoint: str, *, params: dict = {}, base: str = None):
         if base is None:
             base = self.baseurl
         return Endpoint(endpoint, params=params, base=base)
 
+    def _new_session(self):
+        session = requests.Session()
+        session.verify = self.verify
+        adapter = PoolAdapter(self.pool_size, self.keepalive)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
     def login(self, username, password):
-        self.session = requests.Session()
+        self.session = self._new_session()
         self.session.auth = (username, password)
+        self._token_key = f"login:{self.baseurl}:{username}"
+        self._obtain_token = lambda: self._obtain_login_token(username, password)
+        self._authorize()
+
+    def oidcLogin(self, url, username, password, clientId, clientSecret, scope):
+        self.session = self._new_session()
+        self._token_key = f"oidc:{url}:{clientId}:{username}:{scope}"
+        self._obtain_token = lambda: self._obtain_oidc_token(
+            url, username, password, clientId, clientSecret, scope
+        )
+        self._authorize()
+
+    def _obtain_login_token(self, username, password):
+        # A rejected token must not be sent along with the login
+        self.session.headers = requests.utils.default_headers()
         auth_data = {"username": username, "password": password}
         token_response = self.session.post(
             self.ep("auth/token/obtain", params={"format": "json"}), data=auth_data
@@ -78,17 +261,17 @@ class Mayan(object):
             raise Exception("Login Failed")
         _logger.debug("Response: %s", token_response.content)
         token = token_response.json()["token"]
-        self.session.headers = {
-            "Content-type": "application/json",
-            "Accept": "application/json",
-            "Authorization": f"Token {token}",
-        }
+        # Mayan tokens do not expire
+        return f"Token {token}", None
 
-    def oidcLogin(self, url, username, password, clientId, clientSecret, scope):
-        self.session = requests.Session()
+    def _obtain_oidc_token(
+        self, url, username, password, clientId, clientSecret, scope
+    ):
         headers = {
             "Content-type": "application/x-www-form-urlencoded",
             "Accept": "application/json",
+            # A rejected mayan token must not be sent to the identity provider
+            "Authorization": None,
         }
         auth_data = {
             "grant_type": "client_credentials",
@@ -98,41 +281,194 @@ class Mayan(object):
             "client_secret": clientSecret,
             "scope": scope,
         }
-        token_response = requests.post(url, data=auth_data, headers=headers)
+        token_response = self.session.post(url, data=auth_data, headers=headers)
         _logger.debug("Login returned status: %s", token_response.status_code)
         if token_response.status_code != 200:
             raise Exception("Login Failed")
         _logger.debug("Response: %s", token_response.content)
-        token = token_response.json()["access_token"]
+        token_json = token_response.json()
+        return f"Bearer {token_json['access_token']}", token_json.get("expires_in")
+
+    def _authorize(self, rejected=None):
+        # rejected is the authorization that was refused by mayan and must
+        # not be used again even if it is still cached
+        authorization = None
+        if self.token_cache is not None:
+            authorization = self.token_cache.get(self._token_key)
+        if authorization is None or authorization == rejected:
+            if self.token_cache is None:
+                authorization, _ = self._obtain_token()
+            else:
+                with self.token_cache.lock(self._token_key):
+                    # Another worker may have obtained a token in the meantime
+                    authorization = self.token_cache.get(self._token_key)
+                    if authorization is None or authorization == rejected:
+                        _logger.debug("Obtaining new mayan token")
+                        authorization, expires_in = self._obtain_token()
+                        self.token_cache.set(self._token_key, authorization, expires_in)
+        else:
+            _logger.debug("Using cached mayan token")
         self.session.headers = {
             "Content-type": "application/json",
             "Accept": "application/json",
-            "Authorization": f"Bearer {token}",
+            "Authorization": authorization,
         }
 
-    def load(self):
-        self.content_types = self.all("content_types")
-        self.document_types = {x["label"]: x for x in self.all("document_types")}
-        self.metadata_types = self.all("metadata_types")
-        self.tags = {x["label"]: x for x in self.all("tags")}
-        for dt, document_type in self.document_types.items():
-            self.document_types[dt]["metadatas"] = self.all(
-                self.ep("metadata_types", base=document_type["url"])
+    def _send(self, method, endpoint, **kwargs):
+        result = self._retried_request(method, endpoint, **kwargs)
+        if result.status_code == 401 and self._obtain_token is not None:
+            _logger.info("Mayan token was rejected. Obtaining a new token.")
+            self._authorize(rejected=self.session.headers.get("Authorization"))
+            if self._rewind(kwargs):
+                result = self._retried_request(method, endpoint, **kwargs)
+        return result
+
+    def _rewind(self, kwargs):
+        # Prepares the body of a request to be sent again, returns False if
+        # that is not possible
+        if isinstance(kwargs.get("data"), MultipartStream):
+            # A streamed body has been consumed
+            return False
+        for file in kwargs.get("files", {}).values():
+            if hasattr(file, "seek"):
+                file.seek(0)
+        return True
+
+    def _retried_request(self, method, endpoint, **kwargs):
+        attempt = 0
+        while True:
+            result = self._timed_request(method, endpoint, **kwargs)
+            if (
+                result.status_code not in RETRY_STATUS
+                or attempt >= self.retries
+                or not self._rewind(kwargs)
+            ):
+                return result
+            delay = self.backoff * 2**attempt
+            retry_after = result.headers.get("Retry-After", "")
+            if retry_after.isdigit():
+                delay = max(delay, int(retry_after))
+            attempt += 1
+            _logger.info(
+                "Mayan returned status %s. Retry %d of %d in %.1f seconds.",
+                result.status_code,
+                attempt,
+                self.retries,
+                delay,
             )
+            result.close()
+            time.sleep(delay)
+
+    def _timed_request(self, method, endpoint, **kwargs):
+        with metrics.timer(
+            "mayan_request_duration_seconds",
+            method=method,
+            endpoint=metrics.endpoint_label(endpoint, self.baseurl),
+        ):
+            return self.session.request(method, endpoint, **kwargs)
+
+    def _load_catalog(self, name, loader):
+        # Catalog entries are only retrieved from mayan when they are used
+        if name not in self._catalog:
+            value = None
+            if self.catalog_cache is not None:
+                value = self.catalog_cache.get(self.baseurl, name)
+            if value is None:
+                value = loader()
+                if self.catalog_cache is not None:
+                    self.catalog_cache.set(self.baseurl, name, value)
+            self._catalog[name] = value
+        return self._catalog[name]
 
-    def all(self, endpoint: Union[str, Endpoint]):
+    @property
+    def content_types(self):
+        return self._load_catalog("content_types", lambda: self.all("content_types"))
+
+    @property
+    def document_types(self):
+        return self._load_catalog(
+            "document_types",
+            lambda: {x["label"]: x for x in self.all("document_types")},
+        )
+
+    @property
+    def metadata_types(self):
+        return self._load_catalog("metadata_types", lambda: self.all("metadata_types"))
+
+    @property
+    def tags(self):
+        return self._load_catalog(
+            "tags", lambda: {x["label"]: x for x in self.all("tags")}
+        )
+
+    def document_type_metadatas(self, label):
+        return self._load_catalog(
+            "metadatas:" + label,
+            lambda: self.all(
+                self.ep("metadata_types", base=self.document_types[label]["url"])
+            ),
+        )
+
+    def invalidate_catalog(self):
+        self._catalog = {}
+        if self.catalog_cache is not None:
+            self.catalog_cache.invalidate(self.baseurl)
+
+    def load(self):
+        self.content_types
+        self.metadata_types
+        self.tags
+        for dt in self.document_types.keys():
+            self.document_types[dt]["metadatas"] = self.document_type_metadatas(dt)
+
+    def all(self, endpoint: Union[str, Endpoint], page_workers: int = None):
         if isinstance(endpoint, str):
             endpoint = self.ep(endpoint)
+        if page_workers is None:
+            page_workers = self.page_workers
         results = []
         page = {"next": endpoint}
         while page["next"] != None:
             if isinstance(page["next"], str):
                 page["next"] = self.ep(page["next"])
-            result = self.session.get(page["next"])
+            result = self._send("GET", page["next"])
             page = result.json()
             results += page["results"]
+            if (
+                page_workers > 1
+                and page["next"]
+                and page.get("count")
+                and page["results"]
+            ):
+                # The first page tells us how many pages follow
+                return results + self._remaining_pages(page, page_workers)
+        return results
+
+    def _remaining_pages(self, first_page, page_workers):
+        page_size = len(first_page["results"])
+        pages = math.ceil(first_page["count"] / page_size)
+        scheme, netloc, path, query, fragment = urlsplit(str(first_page["next"]))
+        params = dict(parse_qsl(query))
+
+        def page_url(number):
+            params["page"] = str(number)
+            return urlunsplit((scheme, netloc, path, urlencode(params), fragment))
+
+        urls = [page_url(number) for number in range(2, pages + 1)]
+        _logger.debug("Retrieving %d pages with %d workers", len(urls), page_workers)
+
+        def fetch(url):
+            return self._send("GET", url).json()["results"]
+
+        results = []
+        with ThreadPoolExecutor(max_workers=page_workers) as executor:
+            for page_results in executor.map(fetch, urls):
+                results += page_results
         return results
 
+    def batch(self):
+        return WriteBatch(self, self.write_workers)
+
     def first(self, endpoint: Union[str, Endpoint]):
         page = self.get(endpoint)
         return page["results"]
@@ -140,7 +476,7 @@ class Mayan(object):
     def get(self, endpoint: Union[str, Endpoint]):
         if endpoint is str:
             endpoint = self.ep(endpoint)
-        result = self.session.get(endpoint, verify=False)
+        result = self._send("GET", endpoint)
         if result.status_code != 200:
             _logger.warning(json.dumps(result.json(), indent=2))
         return result.json()
@@ -151,7 +487,7 @@ class Mayan(object):
         if self.test:
             print("WOULD POST", str(endpoint), json.dumps(json_data, indent=2))
             return {}
-        result = self.session.post(endpoint, json=json_data, verify=False)
+        result = self._send("POST", endpoint, json=json_data)
         if result.status_code not in [200, 201]:
             _logger.warning(json.dumps(result.json(), indent=2))
         try:
@@ -165,24 +501,75 @@ class Mayan(object):
         if self.test:
             print("WOULD POST", str(endpoint), json.dumps(json_data, indent=2))
             return {}
-        print(self.session.headers)
-        result = self.session.post(
-            endpoint, data=json_data, files=file_data, headers={"Content-type": None}
+        result = self._send(
+            "POST",
+            endpoint,
+            data=json_data,
+            files=file_data,
+            headers={"Content-type": None},
         )
         if result.status_code != 202:
-            _logger.warning(json.dumps(result.json(), indent=2))
+            # Error pages of proxies, e.g. for 413, are not JSON
+            _logger.warning(result.text)
+            raise Exception(
+                "Upload to %s failed with status %s" % (endpoint, result.status_code)
+            )
         try:
             return result.json()
         except JSONDecodeError:
             return {}
 
+    def uploadstream(
+        self,
+        endpoint: Union[str, Endpoint],
+        json_data,
+        name,
+        filename,
+        fileobj,
+        length,
+        content_type="application/octet-stream",
+    ):
+        # Like uploadfile but sends the file while it is read from fileobj
+        if endpoint is str:
+            endpoint = self.ep(endpoint)
+        if self.test:
+            print("WOULD POST", str(endpoint), json.dumps(json_data, indent=2))
+            return {}
+        body = MultipartStream(json_data, name, filename, fileobj, length, content_type)
+        result = self._send(
+            "POST",
+            endpoint,
+            data=body,
+            headers={"Content-type": body.content_type},
+        )
+        if result.status_code != 202:
+            # Error pages of proxies, e.g. for 413, are not JSON
+            _logger.warning(result.text)
+            raise Exception(
+                "Upload to %s failed with status %s" % (endpoint, result.status_code)
+            )
+        try:
+            return result.json()
+        except JSONDecodeError:
+            return {}
+
+    def delete(self, endpoint: Union[str, Endpoint]):
+        if endpoint is str:
+            endpoint = self.ep(endpoint)
+        if self.test:
+            print("WOULD DELETE", str(endpoint))
+            return
+        result = self._send("DELETE", endpoint)
+        if result.status_code not in [202, 204]:
+            _logger.warning("Deleting %s returned status %s", endpoint, result.status_code)
+
     def put(self, endpoint: Union[str, Endpoint], json_data):
         if endpoint is str:
             endpoint = self.ep(endpoint)
         if self.test:
             print("WOULD PUT", str(endpoint), json.dumps(json_data, indent=2))
             return {}
-        result = self.session.put(endpoint, json=json_data)
+        result = self._send("PUT", endpoint, json=json_data)
         if result.status_code != 200:
             _logger.warning(json.dumps(result.json(), indent=2))
         try:
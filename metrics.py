@@ -0,0 +1,151 @@
+from contextlib import contextmanager
+from prometheus_client.core import CounterMetricFamily
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.core import HistogramMetricFamily
+import functools
+import json
+import logging
+import os
+import re
+import redis
+import time
+
+_logger = logging.getLogger(__name__)
+
+# Metrics are recorded by the worker processes and served by the web process
+# so they are kept in the redis instance both of them share (REDIS_URL).
+# Short timeouts make sure that a missing redis does not slow down the jobs.
+redis_conn = redis.from_url(os.getenv('REDIS_URL', 'redis://localhost'),
+                            socket_timeout=1, socket_connect_timeout=1)
+KEY = 'metrics'
+
+# Upper bounds of the histogram buckets in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900)
+
+METRICS = {
+    'comdirect_job_duration_seconds': ('histogram', 'Duration of the worker jobs'),
+    'comdirect_api_request_duration_seconds': ('histogram', 'Latency of the requests sent to the Comdirect API'),
+    'comdirect_api_responses': ('counter', 'Responses of the Comdirect API by status code'),
+    'comdirect_rate_limit_wait_seconds': ('histogram', 'Time spent waiting for the rate limit before a Comdirect request'),
+    'comdirect_api_lock_wait_seconds': ('histogram', 'Time spent waiting for the api_lock'),
+    'mayan_request_duration_seconds': ('histogram', 'Latency of the requests sent to Mayan EDMS'),
+    'comdirect_cache_lookups': ('counter', 'Cache lookups by result (hit or miss)'),
+    'comdirect_postbox_bytes': ('counter', 'Bytes of postbox documents downloaded from Comdirect and uploaded to Mayan EDMS'),
+}
+
+
+def _field(name, labels, suffix):
+    return json.dumps([name, suffix, sorted(labels.items())])
+
+
+def _record(name, increments):
+    try:
+        pipe = redis_conn.pipeline(transaction=False)
+        for field, value in increments:
+            pipe.hincrbyfloat(KEY, field, value)
+        pipe.execute()
+    except redis.RedisError as e:
+        _logger.debug('Failed to record metric %s: %s', name, e)
+
+
+def inc(name, value=1, **labels):
+    _record(name, [(_field(name, labels, ''), value)])
+
+
+def observe(name, value, **labels):
+    # Only the bucket the value falls into is incremented, the buckets
+    # are accumulated when the metrics are collected
+    le = next((str(bound) for bound in BUCKETS if value <= bound), '+Inf')
+    _record(name, [(_field(name, labels, 'bucket:' + le), 1),
+                   (_field(name, labels, 'sum'), value)])
+
+
+@contextmanager
+def timer(name, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+@contextmanager
+def locked(lock, name, **labels):
+    # Acquires the lock and records the time spent waiting for it
+    start = time.perf_counter()
+    with lock:
+        observe(name, time.perf_counter() - start, **labels)
+        yield
+
+
+def job(func):
+    # Records the duration of a worker job by its name and outcome
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        status = 'failure'
+        try:
+            result = func(*args, **kwargs)
+            status = 'success'
+            return result
+        finally:
+            observe('comdirect_job_duration_seconds', time.perf_counter() - start,
+                    job=func.__name__, status=status)
+    return wrapper
+
+
+def endpoint_label(url, baseurl=''):
+    # Object IDs are replaced to keep the number of label values small.
+    # url may also be a mayan.Endpoint.
+    url = str(url)
+    path = url[len(baseurl):] if url.startswith(baseurl) else url
+    path = path.split('?')[0]
+    return re.sub(r'(?<=/)\d+(?=/|$)', ':id', path)
+
+
+class RedisCollector:
+    """Collects the metrics recorded by the workers for prometheus_client."""
+
+    def __init__(self, redis_conn) -> None:
+        self.redis_conn = redis_conn
+
+    def collect(self):
+        samples = {}
+        for field, value in self.redis_conn.hgetall(KEY).items():
+            name, suffix, labels = json.loads(field)
+            samples.setdefault(name, {}).setdefault(
+                tuple(tuple(label) for label in labels), {})[suffix] = float(value)
+
+        for name, (kind, documentation) in METRICS.items():
+            series = samples.get(name, {})
+            label_names = [label for label, _ in next(iter(series), ())]
+            if kind == 'counter':
+                family = CounterMetricFamily(name, documentation, labels=label_names)
+                for labels, values in series.items():
+                    family.add_metric([value for _, value in labels], values[''])
+            else:
+                family = HistogramMetricFamily(name, documentation, labels=label_names)
+                for labels, values in series.items():
+                    buckets = []
+                    count = 0
+                    for le in [str(bound) for bound in BUCKETS] + ['+Inf']:
+                        count += values.get('bucket:' + le, 0)
+                        buckets.append((le, count))
+                    family.add_metric([value for _, value in labels], buckets, values.get('sum', 0))
+            yield family
+
+
+class QueueCollector:
+    """Reports the number of jobs of the rq queue by state."""
+
+    def __init__(self, queue) -> None:
+        self.queue = queue
+
+    def collect(self):
+        family = GaugeMetricFamily('comdirect_queue_jobs', 'Jobs of the worker queue by state',
+                                   labels=['state'])
+        family.add_metric(['queued'], self.queue.count)
+        family.add_metric(['started'], self.queue.started_job_registry.count)
+        family.add_metric(['scheduled'], self.queue.scheduled_job_registry.count)
+        family.add_metric(['failed'], self.queue.failed_job_registry.count)
+        yield family
@@ -0,0 +1,189 @@
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import logging
+import pdfkit
+import subprocess
+import threading
+
+_logger = logging.getLogger(__name__)
+
+
+def content_size(content):
+    if content is None:
+        return 0
+    if isinstance(content, str):
+        return len(content.encode('utf-8'))
+    return len(content)
+
+
+def content_hash(content):
+    if content is None:
+        return None
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    return hashlib.sha256(content).hexdigest()
+
+
+class DownloadStream:
+    """File-like view of a streamed download that is read in chunks.
+
+    Reading pulls at most chunk_size bytes from the network at a time so
+    that the download can be passed on, e.g. as an upload body, without
+    holding the whole document in memory. The content hash and size are
+    available once the stream has been read completely.
+    """
+
+    def __init__(self, response, chunk_size=64 * 1024) -> None:
+        self.response = response
+        self.chunk_size = chunk_size
+        length = response.headers.get('Content-Length')
+        # None if the server did not announce the size
+        self.length = int(length) if length is not None else None
+        self.bytes_read = 0
+        self.hash = hashlib.sha256()
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.chunk_size:
+            size = self.chunk_size
+        data = self.response.raw.read(size)
+        if not data and self.length is not None and self.bytes_read < self.length:
+            # Don't let the consumer mistake a broken download for the end
+            raise IOError('Download ended after %d of %d bytes' % (self.bytes_read, self.length))
+        self.hash.update(data)
+        self.bytes_read += len(data)
+        return data
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+    def close(self):
+        self.response.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class HtmlConverter:
+    """Converts HTML messages to PDF with wkhtmltopdf.
+
+    Every conversion runs in its own wkhtmltopdf process which is killed
+    after timeout seconds.
+    """
+
+    def __init__(self, timeout=60) -> None:
+        self.timeout = timeout
+        self.binary = None
+
+    def __call__(self, content):
+        if self.binary is None:
+            # Raises an error if wkhtmltopdf is not installed
+            self.binary = pdfkit.configuration().wkhtmltopdf
+        try:
+            result = subprocess.run(
+                [self.binary, '--quiet', '--encoding', 'utf-8', '-', '-'],
+                input=content.encode('utf-8'), capture_output=True,
+                timeout=self.timeout, check=True)
+        except subprocess.TimeoutExpired:
+            raise Exception('Conversion to PDF took longer than %d seconds' % self.timeout)
+        except subprocess.CalledProcessError as e:
+            raise Exception('Conversion to PDF failed: ' + e.stderr.decode(errors='replace'))
+        return result.stdout
+
+
+class PostboxPipeline:
+    """Overlaps download, conversion and upload of postbox documents.
+
+    Documents are submitted by the caller as soon as they are downloaded.
+    HTML documents are converted to PDF by convert(content) in a thread
+    pool, after which upload(document, pdf) runs in a second thread pool. Submitting
+    blocks while queue_size documents are still being converted or uploaded
+    so that downloads can't get too far ahead of the slower stages.
+
+    Streamed documents (a DownloadStream as content) are read by the upload
+    itself. reserve_stream() blocks before such a download is opened while
+    upload_workers streamed documents are in flight, so that downloads are
+    not left idle while they wait for an upload worker.
+    """
+
+    def __init__(self, convert, upload, convert_workers=2, upload_workers=4, queue_size=8) -> None:
+        self.convert = convert
+        self.upload = upload
+        self.convert_workers = convert_workers
+        self.upload_workers = upload_workers
+        self.slots = threading.BoundedSemaphore(queue_size)
+        self.streams = threading.BoundedSemaphore(upload_workers)
+        self.in_flight = 0
+        self.idle = threading.Condition()
+        self.imported = 0
+        self.errors = []
+
+    def __enter__(self):
+        # The conversion itself runs in external processes (see HtmlConverter)
+        self.convert_pool = ThreadPoolExecutor(max_workers=self.convert_workers)
+        self.upload_pool = ThreadPoolExecutor(max_workers=self.upload_workers)
+        return self
+
+    def __exit__(self, *args):
+        with self.idle:
+            self.idle.wait_for(lambda: self.in_flight == 0)
+        self.convert_pool.shutdown()
+        self.upload_pool.shutdown()
+
+    def reserve_stream(self):
+        self.streams.acquire()
+
+    def release_stream(self):
+        # Only needed if a reserved download is not submitted as a stream
+        self.streams.release()
+
+    def submit(self, document):
+        self.slots.acquire()
+        with self.idle:
+            self.in_flight += 1
+        # The content is handed over to the next stage only
+        content = document.pop('content', None)
+        try:
+            if document['mimeType'] == 'text/html':
+                future = self.convert_pool.submit(self.convert, content)
+                future.add_done_callback(
+                    lambda f: self.__converted(document, f))
+            else:
+                self.__schedule_upload(document, content)
+        except Exception as e:
+            self.__finished(document, e, isinstance(content, DownloadStream))
+
+    def __converted(self, document, future):
+        try:
+            pdf = future.result()
+        except Exception as e:
+            self.__finished(document, e)
+            return
+        self.__schedule_upload(document, pdf)
+
+    def __schedule_upload(self, document, pdf):
+        streamed = isinstance(pdf, DownloadStream)
+        try:
+            future = self.upload_pool.submit(self.upload, document, pdf)
+            future.add_done_callback(
+                lambda f: self.__finished(document, f.exception(), streamed))
+        except Exception as e:
+            self.__finished(document, e, streamed)
+
+    def __finished(self, document, error, streamed=False):
+        # Runs in the threads of both pools
+        if error is not None:
+            _logger.error('Failed to import document %s: %s',
+                          document.get('name'), error)
+        if streamed:
+            self.streams.release()
+        self.slots.release()
+        with self.idle:
+            if error is None:
+                self.imported += 1
+            else:
+                self.errors.append((document, error))
+            self.in_flight -= 1
+            self.idle.notify_all()
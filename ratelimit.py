@@ -0,0 +1,65 @@
+import logging
+import time
+
+_logger = logging.getLogger(__name__)
+
+# Takes a token from the bucket and returns how long the caller has to wait
+# before it may use it. The bucket may become negative which queues callers
+# in the order of their arrival. The redis server time is used so that the
+# clocks of the workers do not matter.
+_TOKEN_BUCKET = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'timestamp')
+local tokens = tonumber(bucket[1]) or capacity
+local timestamp = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - timestamp) * rate)
+local wait = 0
+if tokens < 1 then
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens - 1, 'timestamp', now)
+redis.call('EXPIRE', KEYS[1], math.ceil((capacity + 1) / rate) + 60)
+redis.call('HINCRBY', KEYS[2], 'requests', 1)
+if wait > 0 then
+    redis.call('HINCRBY', KEYS[2], 'waits', 1)
+    redis.call('HINCRBYFLOAT', KEYS[2], 'wait_seconds', wait)
+end
+return tostring(wait)
+"""
+
+
+class RateLimiter:
+    """Token bucket shared by all processes using the same redis."""
+
+    def __init__(self, redis_conn, name, rate, burst=1) -> None:
+        # burst is the number of requests that may be sent at once
+        # after a period of inactivity
+        self.redis_conn = redis_conn
+        self.key = 'rate_limit:' + name
+        self.stats_key = 'rate_limit_stats:' + name
+        self.rate = rate
+        self.burst = burst
+        self.script = redis_conn.register_script(_TOKEN_BUCKET)
+
+    def reserve(self):
+        # Returns the seconds to wait before the reserved request may be sent
+        return float(self.script(keys=[self.key, self.stats_key],
+                                 args=[self.rate, self.burst]))
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            _logger.debug('Rate limit reached. Waiting %.3f seconds', wait)
+            time.sleep(wait)
+        return wait
+
+    def stats(self):
+        stats = self.redis_conn.hgetall(self.stats_key)
+        return {
+            'requests': int(stats.get(b'requests', 0)),
+            'waits': int(stats.get(b'waits', 0)),
+            'wait_seconds': float(stats.get(b'wait_seconds', 0)),
+        }
@@ -1,8 +1,16 @@
 from comdirectworker import import_postbox
+from comdirectworker import invalidate_mayan_catalog
 from comdirectworker import keepalive
-from comdirectworker import transaction
+from comdirectworker import match_pending
+from comdirectworker import reconcile
+from datetime import timedelta
 from flask import Flask
 from flask import request
+from prometheus_client import CONTENT_TYPE_LATEST
+from prometheus_client import CollectorRegistry
+from prometheus_client import generate_latest
+import batching
+import metrics
 import os
 import redis
 import rq
@@ -11,10 +19,28 @@ import rq
 redis_conn = redis.from_url(os.getenv('REDIS_URL', 'redis://localhost'))
 # no args implies the default queue
 q = rq.Queue('comdirect', connection=redis_conn)
+# Triggers arriving within this number of seconds are matched in a single run
+pending = batching.PendingTransactions(
+    redis_conn, int(os.getenv('TRANSACTION_BATCH_WINDOW', 10)))
+
+# Metrics are collected from redis on every scrape
+registry = CollectorRegistry()
+registry.register(metrics.RedisCollector(redis_conn))
+registry.register(metrics.QueueCollector(q))
 
 app = Flask('COMDIRECT')
 
 
+def schedule_transactions(documents, interactive):
+    # Documents that are already pending are not matched twice and only
+    # the first trigger after a run schedules the next one
+    if pending.add(documents, interactive):
+        if pending.window > 0:
+            q.enqueue_in(timedelta(seconds=pending.window), match_pending)
+        else:
+            q.enqueue(match_pending)
+
+
 @app.route('/')
 def hello_world():
     return 'Nothing Here'
@@ -23,7 +49,30 @@ def hello_world():
 @app.route('/transaction/<int:document_id>', methods=['GET', 'POST'])
 def trigger_transaction(document_id):
     interactive = request.args.get('interactive', default=False, type=bool)
-    q.enqueue(transaction, str(document_id), interactive)
+    schedule_transactions([str(document_id)], interactive)
+    return 'OK'
+
+
+@app.route('/transactions', methods=['GET', 'POST'])
+def trigger_transactions():
+    interactive = request.args.get('interactive', default=False, type=bool)
+    documents = request.args.get('documents', default='', type=str).split(',')
+    body = request.get_json(silent=True)
+    if isinstance(body, dict):
+        documents += [str(d) for d in body.get('documents', [])]
+    documents = [d.strip() for d in documents if d.strip()]
+    if not all(d.isnumeric() for d in documents):
+        return 'Document IDs must be numeric', 400
+    if len(documents) == 0:
+        return 'No documents given', 400
+    schedule_transactions(documents, interactive)
+    return 'OK'
+
+
+@app.route('/reconcile', methods=['GET', 'POST'])
+def trigger_reconcile():
+    interactive = request.args.get('interactive', default=False, type=bool)
+    q.enqueue(reconcile, interactive)
     return 'OK'
 
 
@@ -41,3 +90,14 @@ def trigger_postbox():
 def trigger_keepalive():
     q.enqueue(keepalive)
     return 'OK'
+
+
+@app.route('/mayan/invalidate', methods=['GET', 'POST'])
+def trigger_mayan_invalidate():
+    q.enqueue(invalidate_mayan_catalog)
+    return 'OK'
+
+
+@app.route('/metrics', methods=['GET'])
+def serve_metrics():
+    return generate_latest(registry), 200, {'Content-Type': CONTENT_TYPE_LATEST}